@@ -0,0 +1,284 @@
+import asyncio
+from collections import deque
+from typing import Dict, List, Union, Optional, Iterable, Deque, Type
+
+from observer import IObserver
+from result import IResult
+from sample import ProbeSample, iter_samples, is_alive, parse_timestamp
+from targets import AddressSet
+
+
+class Event:
+    """ Something that changed about one host; the topic is the class name """
+    __slots__ = 'service', 'address', 'timestamp'
+
+    def __init__(self, service: str, address: str, timestamp: int):
+        self.service = service
+        self.address = address
+        self.timestamp = timestamp
+
+    @property
+    def topic(self) -> str:
+        return type(self).__name__
+
+    def as_dict(self) -> dict:
+        return {'event': self.topic, 'service': self.service, 'address': self.address, 'time': self.timestamp}
+
+    def __repr__(self):
+        return f'{self.topic}({self.address}, {self.timestamp})'
+
+
+class HostDown(Event):
+    __slots__ = ()
+
+
+class HostUp(Event):
+    __slots__ = 'down_since',
+
+    def __init__(self, service: str, address: str, timestamp: int, down_since: int = None):
+        super().__init__(service, address, timestamp)
+        self.down_since = down_since
+
+    def as_dict(self) -> dict:
+        return {**super().as_dict(), 'down_since': self.down_since}
+
+
+class RttEvent(Event):
+    __slots__ = 'rtt', 'baseline'
+
+    def __init__(self, service: str, address: str, timestamp: int, rtt: float, baseline: float):
+        super().__init__(service, address, timestamp)
+        self.rtt = rtt
+        self.baseline = baseline
+
+    def as_dict(self) -> dict:
+        return {**super().as_dict(), 'rtt': self.rtt, 'baseline': self.baseline}
+
+
+class RttDegraded(RttEvent):
+    __slots__ = ()
+
+
+class RttRecovered(RttEvent):
+    __slots__ = ()
+
+
+class RttSample(Event):
+    """ Every RTT measurement of a host that is up, for live charts; only sent to subscribers asking for it """
+    __slots__ = 'rtt',
+
+    def __init__(self, service: str, address: str, timestamp: int, rtt: float):
+        super().__init__(service, address, timestamp)
+        self.rtt = rtt
+
+    def as_dict(self) -> dict:
+        return {**super().as_dict(), 'rtt': self.rtt}
+
+
+TOPICS: Dict[str, Type[Event]] = {event.__name__: event for event in
+                                  (HostDown, HostUp, RttDegraded, RttRecovered, RttSample)}
+# What a subscription without TOPICS gets: changes of state, not every sample.
+STATE_TOPICS = frozenset(topic for topic in TOPICS if topic != 'RttSample')
+
+
+class HostState:
+    """ What the bus remembers about a host to tell a change from a repeat """
+    __slots__ = 'alive', 'since', 'rtt', 'baseline', 'samples', 'degraded'
+
+    def __init__(self, alive: bool, since: int):
+        self.alive = alive
+        self.since = since
+        self.rtt = None
+        self.baseline = 0.0
+        self.samples = 0
+        self.degraded = False
+
+
+class Subscription:
+    """ Bounded queue of the events one subscriber asked for. A consumer that falls behind never blocks
+    the bus: it loses the oldest events, counted in DROPPED, or with DISCONNECT the subscription is
+    closed and OVERFLOWED set, for consumers that cannot live with gaps """
+
+    def __init__(self, bus: 'EventBus', topics: Iterable[str] = None, hosts: List[AddressSet] = None,
+                 maxsize: int = 1000, disconnect: bool = False):
+        self._bus = bus
+        self._topics = frozenset(topics) if topics is not None else STATE_TOPICS
+        self._hosts = hosts
+        self._events: Deque[Event] = deque(maxlen=maxsize)
+        self._disconnect = disconnect
+        self._ready = asyncio.Event()
+        self._closed = False
+        self.dropped = 0
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def wants(self, topic: str) -> bool:
+        return topic in self._topics
+
+    def watches(self, address: str) -> bool:
+        return self._hosts is None or any(address in hosts for hosts in self._hosts)
+
+    def matches(self, event: Event) -> bool:
+        return event.topic in self._topics and self.watches(event.address)
+
+    def put(self, event: Event):
+        if len(self._events) == self._events.maxlen:
+            if self._disconnect:
+                self.overflowed = True
+                self.close()
+                return
+            self.dropped += 1
+        self._events.append(event)
+        self._ready.set()
+
+    def get_nowait(self) -> Optional[Event]:
+        return self._events.popleft() if self._events else None
+
+    async def get(self) -> Optional[Event]:
+        """ The next event, None once the subscription is closed and drained """
+        while not self._events and not self._closed:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Event:
+        event = await self.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._ready.set()
+            self._bus.unsubscribe(self)
+
+
+class EventBus(IObserver):
+    """ Turns probe results into events on state changes only.
+
+    Attached next to the storage observer, it keeps one HostState per host: HostDown/HostUp when
+    is_alive flips, RttDegraded/RttRecovered when the RTT leaves or returns to RTT_FACTOR times its
+    moving average (and at least RTT_MARGIN ms above it). A host first seen down raises HostDown,
+    one first seen up raises nothing. GROUPS names address sets that subscribers can filter by """
+
+    def __init__(self, **kwargs):
+        self._rtt_factor: float = kwargs.get('rtt_factor', 2.0)
+        self._rtt_margin: float = kwargs.get('rtt_margin', 5.0)
+        self._rtt_warmup: int = kwargs.get('rtt_warmup', 5)
+        self._rtt_alpha: float = kwargs.get('rtt_alpha', 0.1)
+        self._groups: Dict[str, AddressSet] = dict()
+        for name, targets in kwargs.get('groups', dict()).items():
+            self.add_group(name, targets)
+        self._hosts: Dict[str, HostState] = dict()
+        self._subscriptions: List[Subscription] = list()
+        self._published = 0
+
+    def add_group(self, name: str, targets: Union[str, Iterable[str]], exclude: Union[str, Iterable[str]] = None):
+        """ TARGETS are addresses, CIDR blocks or ranges, as for add_device """
+        self._groups.setdefault(name, AddressSet()).update(targets, exclude)
+        return self
+
+    def subscribe(self, topics: Iterable[str] = None, hosts: Union[str, Iterable[str]] = None,
+                  groups: Iterable[str] = None, maxsize: int = 1000, disconnect: bool = False) -> Subscription:
+        """ Events of TOPICS about HOSTS or members of GROUPS; None means every host, and every topic
+        but RttSample """
+        if topics is not None:
+            topics = list(topics)
+            unknown = [topic for topic in topics if topic not in TOPICS]
+            if unknown:
+                raise ValueError(f'Неизвестные типы событий: {", ".join(unknown)}')
+        sets = None
+        if hosts is not None or groups is not None:
+            sets = [AddressSet(hosts)] if hosts is not None else list()
+            for group in groups or ():
+                if group not in self._groups:
+                    raise ValueError(f'Неизвестная группа: {group}')
+                # Shared, so hosts added to the group later are matched too.
+                sets.append(self._groups[group])
+        subscription = Subscription(self, topics, sets, maxsize, disconnect)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        # A new list, as a subscription can close itself while publish() walks the current one.
+        self._subscriptions = [subscription_ for subscription_ in self._subscriptions
+                               if subscription_ is not subscription]
+
+    def publish(self, event: Event):
+        self._published += 1
+        for subscription in self._subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
+
+    def state(self, address: str) -> Optional[HostState]:
+        return self._hosts.get(address)
+
+    def states(self) -> Dict[str, HostState]:
+        return self._hosts
+
+    def update(self, result: Union[IResult, List[IResult]]) -> None:
+        for result_ in result if isinstance(result, list) else [result]:
+            if isinstance(result_, IResult):
+                self._process(result_.get())
+
+    def _process(self, value: dict):
+        # RttSample is the only per-sample event, it is not even built while nobody asked for it.
+        samples = any(subscription.wants('RttSample') for subscription in self._subscriptions)
+        timestamps: Dict[str, int] = dict()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = timestamps.get(date)
+            if timestamp is None:
+                timestamp = timestamps[date] = parse_timestamp(date)
+            alive = is_alive(sample)
+            state = self._hosts.get(address)
+            if state is None:
+                state = self._hosts[address] = HostState(alive, timestamp)
+                if not alive:
+                    self.publish(HostDown(service, address, timestamp))
+            elif alive != state.alive:
+                if alive:
+                    self.publish(HostUp(service, address, timestamp, state.since))
+                else:
+                    self.publish(HostDown(service, address, timestamp))
+                state.alive, state.since = alive, timestamp
+            if alive and isinstance(sample, ProbeSample):
+                state.rtt = sample.avg_rtt
+                self._check_rtt(service, address, timestamp, state, sample.avg_rtt)
+                if samples:
+                    self.publish(RttSample(service, address, timestamp, sample.avg_rtt))
+            else:
+                state.rtt = None
+
+    def _check_rtt(self, service: str, address: str, timestamp: int, state: HostState, rtt: float):
+        if state.samples >= self._rtt_warmup:
+            limit = max(state.baseline * self._rtt_factor, state.baseline + self._rtt_margin)
+            if rtt > limit:
+                if not state.degraded:
+                    state.degraded = True
+                    self.publish(RttDegraded(service, address, timestamp, rtt, state.baseline))
+                # Degraded samples stay out of the average, or it would drift up to them.
+                return
+            if state.degraded:
+                state.degraded = False
+                self.publish(RttRecovered(service, address, timestamp, rtt, state.baseline))
+        state.samples += 1
+        state.baseline = rtt if state.samples == 1 else state.baseline + self._rtt_alpha * (rtt - state.baseline)
+
+    def stats(self) -> dict:
+        return {'hosts': len(self._hosts), 'published': self._published,
+                'subscribers': len(self._subscriptions),
+                'queued': sum(len(subscription) for subscription in self._subscriptions),
+                'dropped': sum(subscription.dropped for subscription in self._subscriptions)}
+
+
+event_bus = EventBus()
@@ -1,30 +1,20 @@
 import asyncio
 from abc import ABC, abstractmethod
-from typing import List, Union, Tuple
+from typing import List, Union, Optional
 
 from loguru import logger
 
 from device import IHaveDevice
+from events import EventBus, event_bus
 from observer import DefaultObserver
 from result import IResult
 from server import IServer
 from service import IService
 from storage import IHaveStorage, IStorageFacade, IHaveStorageFacade
+from storage.storage import write
 from subject import ISubject
-
-
-def distribution_between_consumers(src, target):
-    """ SRC distribution between TARGET """
-    count_devices = len(src)
-    count_services = len(target)
-    remains = count_devices % count_services
-    if count_devices < count_services:
-        quantity_for_each = 1
-    elif remains == 0:
-        quantity_for_each = count_devices / count_services
-    else:
-        quantity_for_each = int((count_devices - remains) / count_services)
-    return quantity_for_each
+from targets import AddressSet, parse_targets
+from work_queue import IWorkQueue, IHaveWorkQueue, WorkStealingQueue
 
 
 class IFacade(ABC):
@@ -97,6 +87,10 @@ class NetworkMonitoringFacade(IFacade, IHaveDevice, DefaultObserver, IHaveStorag
     def get_storage_facade(self) -> IStorageFacade:
         return self._storage_facade
 
+    @property
+    def event_bus(self) -> Optional[EventBus]:
+        return self._event_bus
+
     async def start_servers(self):
         logger.info('Сервера запущены')
         await asyncio.gather(server.start() for server in self._servers)
@@ -115,6 +109,8 @@ class NetworkMonitoringFacade(IFacade, IHaveDevice, DefaultObserver, IHaveStorag
                 _service.set_storage(storage_facade.storage)
             if isinstance(_service, ISubject):
                 _service.attach(storage_facade.observer)
+                if self._event_bus is not None:
+                    _service.attach(self._event_bus)
             self._services.append(_service)
 
     def del_service(self, service: IService):
@@ -134,46 +130,82 @@ class NetworkMonitoringFacade(IFacade, IHaveDevice, DefaultObserver, IHaveStorag
                 _server.set_storage(storage_facade.storage)
             if isinstance(_server, ISubject):
                 _server.attach(storage_facade.observer)
+                if self._event_bus is not None:
+                    _server.attach(self._event_bus)
             self._servers.append(_server)
 
     def del_server(self, server: IServer):
         self._servers.remove(server)
 
-    def add_device(self, device: Union[str, List[str]]):
-        if isinstance(device, str):
-            device = [device]
-        for _device in device:
-            self._device.append(_device)
+    def add_device(self, device: Union[str, List[str]], critical: bool = False, exclude: Union[str, List[str]] = None):
+        """ DEVICE is an address, a CIDR block, a range or a list of them """
+        excluded = AddressSet(exclude) if exclude else AddressSet()
+        added = list()
+        for _device in parse_targets(device):
+            if _device in excluded:
+                continue
+            if self._device.add(_device) or critical:
+                self._work_queue.add(_device, critical=critical)
+                added.append(_device)
+            if critical:
+                self._critical.add(_device)
+        # Services that keep their own devices get them in one call, sharded ones batch it per shard.
+        if added:
+            for service in self._device_owners():
+                service.add_device(added, critical=critical)
         return self
 
-    def del_device(self, device: str):
-        self._device.remove(device)
+    def del_device(self, device: Union[str, List[str]]):
+        removed = list()
+        for _device in parse_targets(device):
+            if self._device.discard(_device):
+                self._critical.discard(_device)
+                self._work_queue.remove(_device)
+                removed.append(_device)
+        if removed:
+            for service in self._device_owners():
+                service.del_device(removed)
+
+    def _device_owners(self) -> List[IHaveDevice]:
+        """ Started services that keep their own devices instead of pulling from the work queue """
+        return [service for service in self._started
+                if isinstance(service, IHaveDevice) and not isinstance(service, IHaveWorkQueue)]
 
     def __init__(self, **kwargs):
         super(DefaultObserver, self).__init__()
         self._services: List[IService] = list()
         self._servers: List[IServer] = list()
-        self._device = list()
+        self._device = AddressSet()
+        self._critical = AddressSet()
+        self._started: List[IService] = list()
+        self._work_queue: IWorkQueue = kwargs.get('work_queue')
+        if self._work_queue is None:
+            self._work_queue = WorkStealingQueue()
         self._storage_facade = kwargs.get('storage_facade')
+        # Services report to the event bus next to the storage; event_bus=None turns events off.
+        self._event_bus: Optional[EventBus] = kwargs.get('event_bus', event_bus)
 
     def update(self, result: Union[IResult, List[IResult]]) -> None:
         storage_facade = self.get_storage_facade()
         if isinstance(result, list):
             for res in result:
-                storage_facade.storage.add_data(res.get())
+                write(storage_facade.storage, res.get())
         elif isinstance(result, IResult):
-            storage_facade.storage.add_data(result.get())
+            write(storage_facade.storage, result.get())
 
     async def start_services(self):
-        services: Tuple[IHaveDevice] = (*filter(lambda d: isinstance(d, IHaveDevice), self._services),)
-        quantity_for_each = distribution_between_consumers(self._device, services)
-
-        for service in services:
-            for device in range(quantity_for_each):
-                try:
-                    service.add_device(self._device.pop(device))
-                except IndexError:
-                    break
+        # Workers pull due hosts from the shared queue, so devices added or
+        # removed later are picked up without redistributing anything.
+        for service in self._services:
+            if isinstance(service, IHaveWorkQueue):
+                service.set_work_queue(self._work_queue)
+            elif isinstance(service, IHaveDevice):
+                devices = [_device for _device in self._device if _device not in self._critical]
+                if devices:
+                    service.add_device(devices)
+                if len(self._critical):
+                    service.add_device(list(self._critical), critical=True)
+        self._started = list(self._services)
 
         logger.info('Службы запущены')
         await asyncio.gather(*(service.start() for service in self._services))
@@ -1,21 +1,29 @@
 import asyncio
 
 from facade import NetworkMonitoringFacade
+from probe import probe_engine
+from ratelimit import RateLimiter
 from result import DictResult
 from routes import api_route, http_route
+from scheduler import ProbeScheduler
 from server import HTTPServer
 from service import SearchDeviceService
-from storage import storage
+from storage import storage, SQLiteStorage
+from work_queue import WorkStealingQueue
 
 
 async def run():
     timeout = 30
-    nmf = NetworkMonitoringFacade(storage_facade=storage)
+    probe_engine.set_rate_limiter(RateLimiter(pps=500, subnet_pps=200))
+    storage.storage = SQLiteStorage(path='network_monitoring.sqlite3', flush_interval=1.0)
+    nmf = NetworkMonitoringFacade(storage_facade=storage,
+                                  work_queue=WorkStealingQueue(scheduler=ProbeScheduler(interval=timeout)))
     nmf.add_service([
-        *[SearchDeviceService(result=DictResult(), timeout=timeout) for _ in range(15)],
+        *[SearchDeviceService(result=DictResult(), timeout=timeout, probe_engine=probe_engine,
+                              stream=True) for _ in range(15)],
         HTTPServer(http=http_route, api=api_route, port=55080)
     ])
-    await nmf.add_device([f'192.168.222.{octet}' for octet in range(1, 255)]).start_services()
+    await nmf.add_device('192.168.222.0/24').start_services()
     # await nmf.start_services()
 
 
@@ -0,0 +1,193 @@
+import asyncio
+from abc import ABC, abstractmethod
+from itertools import count as counter
+from time import time
+from typing import List, Dict, Tuple, Iterable, Optional, AsyncIterator
+
+from icmplib import ICMPv4Socket, ICMPv6Socket, ICMPRequest, Host, is_hostname, is_ipv6_address, async_resolve
+from icmplib.exceptions import ICMPLibError
+from icmplib.utils import unique_identifier
+from loguru import logger
+
+from ratelimit import IRateLimiter, RateLimiter
+from telemetry import registry
+
+PROBES_SENT = registry.counter('nmf_probe_sent_total', 'ICMP echo requests sent')
+PROBES_RECEIVED = registry.counter('nmf_probe_received_total', 'ICMP echo replies received')
+PROBES_TIMEOUTS = registry.counter('nmf_probe_timeouts_total', 'ICMP echo requests left without a reply')
+PROBES_ERRORS = registry.counter('nmf_probe_errors_total', 'ICMP requests that failed to send or got an error reply')
+
+
+class _PooledSocket:
+    __slots__ = 'sock', 'identifier', 'sequence'
+
+    def __init__(self, sock, identifier: int):
+        self.sock = sock
+        self.identifier = identifier
+        self.sequence = 0
+
+
+class IProbeEngine(ABC):
+    @abstractmethod
+    async def probe(self, addresses: Iterable[str], **kwargs) -> List[Host]:
+        pass
+
+    @abstractmethod
+    def stream(self, addresses: Iterable[str], **kwargs) -> AsyncIterator[Host]:
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class ICMPProbeEngine(IProbeEngine):
+    """ One socket pool and one receive loop per process, shared by every service.
+
+    A privileged (raw) socket receives a copy of every ICMP packet on the host, so those get one
+    socket per address family; the SOCKETS pool is only used for unprivileged datagram sockets """
+
+    def __init__(self, **kwargs):
+        self._count: int = kwargs.get('count', 2)
+        self._interval: float = kwargs.get('interval', 0.5)
+        self._timeout: float = kwargs.get('timeout', 2)
+        self._pool_size: int = kwargs.get('sockets', 2)
+        self._privileged: bool = kwargs.get('privileged', True)
+        self._payload_size: int = kwargs.get('payload_size', 56)
+        self._concurrent_tasks: int = kwargs.get('concurrent_tasks', 1000)
+        self._pools: Dict[int, List[_PooledSocket]] = dict()
+        self._next_socket: Dict[int, counter] = dict()
+        self._pending: Dict[Tuple[int, int], asyncio.Future] = dict()
+        self._semaphore = None
+        self._rate_limiter: Optional[IRateLimiter] = kwargs.get('rate_limiter')
+        if self._rate_limiter is None and kwargs.get('pps') is not None:
+            self._rate_limiter = RateLimiter(pps=kwargs['pps'], subnet_pps=kwargs.get('subnet_pps'))
+
+    def set_rate_limiter(self, rate_limiter: IRateLimiter) -> IProbeEngine:
+        self._rate_limiter = rate_limiter
+        return self
+
+    def get_rate_limiter(self) -> Optional[IRateLimiter]:
+        return self._rate_limiter
+
+    def _pool(self, family: int) -> List[_PooledSocket]:
+        pool = self._pools.get(family)
+        if pool is None:
+            loop = asyncio.get_running_loop()
+            socket_class = ICMPv6Socket if family == 6 else ICMPv4Socket
+            pool = list()
+            for index in range(1 if self._privileged else self._pool_size):
+                icmp_sock = socket_class(privileged=self._privileged)
+                icmp_sock.blocking = False
+                loop.add_reader(icmp_sock.sock, self._receive, icmp_sock)
+                # Each pool socket gets its own identifier and replies are matched by (id, sequence).
+                pool.append(_PooledSocket(icmp_sock, (unique_identifier() + index) & 0xffff))
+            self._pools[family] = pool
+            self._next_socket[family] = counter()
+            logger.info(f'Пул ICMPv{family} сокетов открыт: {len(pool)}')
+        return pool
+
+    def _next_request(self, pooled: _PooledSocket, address: str) -> ICMPRequest:
+        while True:
+            pooled.sequence = (pooled.sequence + 1) & 0xffff
+            if (pooled.identifier, pooled.sequence) not in self._pending:
+                return ICMPRequest(destination=address, id=pooled.identifier, sequence=pooled.sequence,
+                                   payload_size=self._payload_size)
+
+    def _receive(self, icmp_sock):
+        while True:
+            try:
+                packet, source = icmp_sock.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logger.error(f'Ошибка чтения ICMP сокета: {err}')
+                return
+            reply = icmp_sock._parse_reply(packet=packet, source=source[0], current_time=time())
+            if reply is None:
+                continue
+            future = self._pending.pop((reply.id, reply.sequence), None)
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+    async def _send(self, address: str, family: int) -> Optional[float]:
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire(address)
+        pool = self._pool(family)
+        pooled = pool[next(self._next_socket[family]) % len(pool)]
+        request = self._next_request(pooled, address)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            pooled.sock.send(request)
+        except ICMPLibError:
+            PROBES_ERRORS.inc()
+            return None
+        PROBES_SENT.inc()
+        # Unprivileged sockets get their identifier rewritten by the kernel on send.
+        pooled.identifier = request.id
+        key = (request.id, request.sequence)
+        self._pending[key] = future
+        try:
+            reply = await asyncio.wait_for(future, self._timeout)
+            reply.raise_for_status()
+            PROBES_RECEIVED.inc()
+            return (reply.time - request.time) * 1000
+        except asyncio.TimeoutError:
+            PROBES_TIMEOUTS.inc()
+            return None
+        except ICMPLibError:
+            PROBES_ERRORS.inc()
+            return None
+        finally:
+            self._pending.pop(key, None)
+
+    async def _ping(self, address: str) -> Host:
+        async with self._semaphore:
+            target = address
+            if is_hostname(target):
+                try:
+                    target = (await async_resolve(target))[0]
+                except ICMPLibError:
+                    return Host(address, 0, [])
+            family = 6 if is_ipv6_address(target) else 4
+            rtts = list()
+            for sequence in range(self._count):
+                if sequence > 0:
+                    await asyncio.sleep(self._interval)
+                rtt = await self._send(target, family)
+                if rtt is not None:
+                    rtts.append(rtt)
+            return Host(address, self._count, rtts)
+
+    async def probe(self, addresses: Iterable[str], **kwargs) -> List[Host]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrent_tasks)
+        return list(await asyncio.gather(*(self._ping(address) for address in addresses)))
+
+    async def stream(self, addresses: Iterable[str], **kwargs) -> AsyncIterator[Host]:
+        """ Yield each host as soon as its last reply arrives or its deadline passes """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._concurrent_tasks)
+        tasks = [asyncio.ensure_future(self._ping(address)) for address in addresses]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        for pool in self._pools.values():
+            for pooled in pool:
+                try:
+                    asyncio.get_event_loop().remove_reader(pooled.sock.sock)
+                except (RuntimeError, ValueError):
+                    pass
+                pooled.sock.close()
+        self._pools.clear()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+
+probe_engine: IProbeEngine = ICMPProbeEngine()
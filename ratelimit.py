@@ -0,0 +1,100 @@
+import asyncio
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import Dict, Optional
+
+from targets import IPV6_FLAG, to_int
+
+
+class IRateLimiter(ABC):
+    @abstractmethod
+    async def acquire(self, address: str):
+        pass
+
+    @abstractmethod
+    def headroom(self) -> float:
+        pass
+
+
+class TokenBucket:
+    """ Tokens may go negative: each caller reserves the next free send slot and sleeps until it """
+    __slots__ = 'rate', 'capacity', 'tokens', 'updated'
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def reserve(self, now: float) -> float:
+        """ Take one token; returns how long to wait before sending """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter(IRateLimiter):
+    """ Global and per-subnet packets-per-second limits shared by every probing service """
+
+    def __init__(self, **kwargs):
+        self._pps: float = kwargs.get('pps', 1000.0)
+        self._subnet_pps: Optional[float] = kwargs.get('subnet_pps')
+        self._subnet_prefix: int = kwargs.get('subnet_prefix', 24)
+        # A burst of 1 spreads sends evenly instead of letting them leave back to back.
+        self._burst: float = kwargs.get('burst', 1.0)
+        self._window: float = kwargs.get('window', 10.0)
+        self._global = TokenBucket(self._pps, self._burst)
+        self._subnets: Dict[int, TokenBucket] = dict()
+        self._window_start = monotonic()
+        self._window_sent = 0
+        self._rate = 0.0
+        self._waiting = 0
+
+    def _subnet(self, address: str) -> Optional[TokenBucket]:
+        if self._subnet_pps is None:
+            return None
+        value = to_int(address)
+        if not isinstance(value, int) or value & IPV6_FLAG:
+            return None
+        key = value >> (32 - self._subnet_prefix)
+        bucket = self._subnets.get(key)
+        if bucket is None:
+            bucket = self._subnets[key] = TokenBucket(self._subnet_pps, self._burst)
+        return bucket
+
+    def _account(self):
+        now = monotonic()
+        self._window_sent += 1
+        elapsed = now - self._window_start
+        if elapsed >= self._window:
+            self._rate = self._window_sent / elapsed
+            self._window_start, self._window_sent = now, 0
+            self._subnets = {key: bucket for key, bucket in self._subnets.items() if not bucket.idle(now)}
+
+    async def acquire(self, address: str):
+        now = monotonic()
+        delay = self._global.reserve(now)
+        subnet = self._subnet(address)
+        if subnet is not None:
+            delay = max(delay, subnet.reserve(now))
+        if delay > 0:
+            self._waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._waiting -= 1
+        self._account()
+
+    def headroom(self) -> float:
+        """ Share of the global budget left unused over the last full window or the current one """
+        rate = max(self._rate, self._window_sent / self._window)
+        return max(0.0, 1.0 - rate / self._pps)
+
+    def stats(self) -> dict:
+        return {'pps': self._pps, 'subnet_pps': self._subnet_pps,
+                'rate': round(max(self._rate, self._window_sent / self._window), 1),
+                'headroom': round(self.headroom(), 3), 'waiting': self._waiting, 'subnets': len(self._subnets)}
@@ -79,6 +79,30 @@ class DictResult(DefaultResult):
         return result
 
 
+class CycleResult(IResult):
+    """ Samples of one probe cycle of one service, built once and never changed: observers receive
+    the object itself and the service keeps only its latest one """
+    __slots__ = '_service', '_timestamp', '_samples'
+
+    def __init__(self, service: str, timestamp: int, samples: dict):
+        self._service = service
+        self._timestamp = timestamp
+        self._samples = samples
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def timestamp(self) -> int:
+        return self._timestamp
+
+    def set(self, value):
+        raise AttributeError('CycleResult нельзя изменить')
+
+    def get(self) -> dict:
+        return {self._service: {self._timestamp: self._samples}}
+
+
 class IHaveJSONResult(ABC):
     @abstractmethod
     def get_data_json(self):
@@ -1,8 +1,169 @@
-from aiohttp import web
+import asyncio
+import json
+
+from aiohttp import web, WSCloseCode, WSMsgType
 
 from routes.loader import api_route, router
-from routes.utilities.selector import selector
-from storage import storage
+from routes.utilities import live
+from routes.utilities.cache import response_cache
+from routes.utilities.export import Export
+from routes.utilities.exposition import render
+from routes.utilities.selector import navigate, select_range, query, RowQuery
+from storage import storage, IngestQueue, IHaveMetrics, IHaveAvailability, IHaveTransitions, IHaveSnapshot
+
+
+@router.get('/metrics')
+async def route_prometheus(request):
+    """ Prometheus text format; counters are kept as things happen, a scrape only formats them """
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@router.get('/api/nmf/metrics')
+@router.get('/api/nmf/metrics/{address}')
+async def route_metrics(request):
+    if not isinstance(storage.storage, IHaveMetrics):
+        return web.json_response(dict())
+    return web.json_response(await query(storage.storage.get_metrics, request.match_info.get('address')))
+
+
+@router.get('/api/nmf/availability')
+@router.get('/api/nmf/availability/{address}')
+async def route_availability(request):
+    """ ?from=&to= epoch seconds; long ranges are answered from the coarse rollup tiers """
+    if not isinstance(storage.storage, IHaveAvailability):
+        return web.json_response(dict())
+    try:
+        start, end = (float(request.query[name]) if name in request.query else None for name in ('from', 'to'))
+    except ValueError:
+        raise web.HTTPBadRequest(text='from и to должны быть числами')
+    return web.json_response(await query(storage.storage.availability, start, end,
+                                         request.match_info.get('address')))
+
+
+@router.get('/api/nmf/ingest')
+async def route_ingest(request):
+    if not isinstance(storage.observer, IngestQueue):
+        return web.json_response(dict())
+    return web.json_response(storage.observer.stats())
+
+
+@router.get('/api/nmf/state')
+@router.get('/api/nmf/state/{address}')
+async def route_state(request):
+    if not isinstance(storage.storage, IHaveTransitions):
+        return web.json_response(dict())
+    address = request.match_info.get('address')
+    if address is None:
+        return web.json_response(storage.storage.current())
+    return web.json_response({'is_alive': storage.storage.current(address),
+                              'down_since': storage.storage.down_since(address),
+                              'transitions': storage.storage.transitions(address)})
+
+
+@router.get('/api/nmf/live')
+async def route_live(request):
+    """ WebSocket: a snapshot of host states, then events as JSON messages. ?topics=&hosts=&groups=
+    filter them; a {"topics": [...], "hosts": [...], "groups": [...]} message replaces the filter and
+    starts over with a new snapshot """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    async def send(topic, data):
+        if topic is not None:
+            await ws.send_str(data)
+
+    async def feed(filters):
+        try:
+            subscription = live.subscribe(filters)
+        except ValueError as exception:
+            await ws.send_json({'event': 'error', 'error': str(exception)})
+            return
+        if not await live.push(subscription, send):
+            await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message='Клиент не успевает читать события'.encode())
+
+    task = asyncio.ensure_future(feed(request.query))
+    try:
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                filters = json.loads(message.data)
+            except ValueError:
+                filters = None
+            if not isinstance(filters, dict):
+                await ws.send_json({'event': 'error', 'error': 'Ожидается JSON-объект с topics, hosts и groups'})
+                continue
+            task.cancel()
+            task = asyncio.ensure_future(feed(filters))
+    finally:
+        task.cancel()
+    return ws
+
+
+@router.get('/api/nmf/events')
+async def route_events(request):
+    """ Server-Sent Events: the same snapshot and events as /api/nmf/live, filtered by ?topics=&hosts=&groups= """
+    try:
+        subscription = live.subscribe(request.query)
+    except ValueError as exception:
+        raise web.HTTPBadRequest(text=str(exception))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+
+        async def send(topic, data):
+            await response.write(f'event: {topic}\ndata: {data}\n\n'.encode() if topic is not None else b':\n\n')
+
+        await live.push(subscription, send, keepalive=15)
+    except ConnectionResetError:
+        pass
+    finally:
+        subscription.close()
+    return response
+
+
+@router.get('/api/nmf/query')
+async def route_query(request):
+    """ Flat rows filtered by ?host=&service=&state=&from=&to=&last=, projected by ?fields= and paged by
+    ?limit=&cursor=, e.g. /api/nmf/query?host=10.1.0.0/16&state=down&last=3600 """
+    try:
+        row_query = RowQuery.from_params(request.query)
+    except ValueError as exception:
+        raise web.HTTPBadRequest(text=str(exception))
+    return await response_cache.respond(request, row_query.run)
+
+
+@router.get('/api/nmf/export')
+async def route_export(request):
+    """ Every row matching the /api/nmf/query filters, streamed as NDJSON or, with ?format=json, as one
+    JSON array; memory stays at one chunk however long the range is """
+    export_format = request.query.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'json'):
+        raise web.HTTPBadRequest(text='format должен быть ndjson или json')
+    try:
+        row_query = RowQuery.from_params(request.query)
+    except ValueError as exception:
+        raise web.HTTPBadRequest(text=str(exception))
+    export = Export(row_query, ndjson=export_format == 'ndjson')
+    response = web.StreamResponse(headers={
+        'Content-Type': export.content_type,
+        'Content-Disposition': f'attachment; filename="nmf-export.{export_format}"'})
+    response.enable_chunked_encoding()
+    try:
+        await response.prepare(request)
+        while True:
+            chunk = await query(export.chunk)
+            if not chunk:
+                break
+            await response.write(chunk)
+            # Other requests get the loop between chunks even when the client reads fast.
+            await asyncio.sleep(0)
+        await response.write_eof()
+    except ConnectionResetError:
+        pass
+    finally:
+        await query(export.close)
+    return response
 
 
 @router.get('/api/nmf')
@@ -12,18 +173,28 @@ from storage import storage
 @router.get('/api/nmf/{value}/{value1}/{value2}/{value3}')
 @router.get('/api/nmf/{value}/{value1}/{value2}/{value3}/{value4}')
 async def route(request):
+    if any(name in request.query for name in ('from', 'to', 'host', 'limit')):
+        try:
+            start, end, limit = (int(request.query[name]) if name in request.query else None
+                                 for name in ('from', 'to', 'limit'))
+        except ValueError:
+            raise web.HTTPBadRequest(text='from, to и limit должны быть целыми числами')
+        return await response_cache.respond(request, lambda: select_range(start, end, request.query.get('host'), limit))
+    if 'value' not in request.match_info and isinstance(storage.storage, IHaveSnapshot):
+        # The snapshot's own JSON view is shared with get_data_json.
+        return await response_cache.respond(request, lambda: storage.storage.snapshot().view('json', json.dumps))
     value = [request.match_info.get('value'),
              request.match_info.get('value1'),
              request.match_info.get('value2'),
              request.match_info.get('value3'),
              request.match_info.get('value4')]
-    return web.json_response(selector(value))
+    return await response_cache.respond(request, lambda: navigate(value))
 
 
 @router.get('/api/nmf/mng/device')
 async def route(request):
     value = request.match_info.get('value')
     if value is None:
-        return web.Response(text=str(storage.storage.get_data()))
+        return web.Response(text=str(await query(storage.storage.get_data)))
     else:
-        return web.Response(text=str(storage.storage.get_data(value)))
+        return web.Response(text=str(await query(storage.storage.get_data, value)))
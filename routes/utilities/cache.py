@@ -0,0 +1,115 @@
+import asyncio
+import gzip
+import json
+from hashlib import blake2b
+from typing import Dict, Any, Callable, Optional
+
+from aiohttp import web
+
+from routes.utilities.selector import query
+from storage import storage, IHaveVersion
+
+
+class CachedResponse:
+    """ Encoded body of one response, plus its gzip form when it is worth compressing """
+    __slots__ = 'etag', 'body', 'gzipped'
+
+    def __init__(self, etag: str, body: bytes, gzipped: Optional[bytes]):
+        self.etag = etag
+        self.body = body
+        self.gzipped = gzipped
+
+
+class ResponseCache:
+    """ JSON responses by request path and query, valid for one storage version.
+
+    The body is serialized, hashed into the ETag and compressed once per version; requests after
+    that cost a dict lookup, and a 304 when the client already has that ETag. The ETag is the hash
+    of the body, so a new version with the same content still answers 304. Storages without
+    IHaveVersion are encoded on every request and only get the 304s """
+
+    def __init__(self, **kwargs):
+        self._max_entries: int = kwargs.get('max_entries', 256)
+        self._compress: bool = kwargs.get('compress', True)
+        self._compress_level: int = kwargs.get('compress_level', 6)
+        self._min_compress: int = kwargs.get('min_compress', 1024)
+        self._version: Optional[int] = None
+        self._entries: Dict[str, CachedResponse] = dict()
+        self._pending: Dict[str, asyncio.Future] = dict()
+        self._hits = 0
+        self._misses = 0
+        self._not_modified = 0
+
+    def _encode(self, build: Callable[[], Any]) -> CachedResponse:
+        value = build()
+        if isinstance(value, str):
+            body = value.encode()
+        elif isinstance(value, bytes):
+            body = value
+        else:
+            body = json.dumps(value).encode()
+        gzipped = gzip.compress(body, self._compress_level) if self._compress and len(body) >= self._min_compress \
+            else None
+        return CachedResponse(f'"{blake2b(body, digest_size=8).hexdigest()}"', body, gzipped)
+
+    async def _get(self, key: str, build: Callable[[], Any]) -> CachedResponse:
+        version = storage.storage.version if isinstance(storage.storage, IHaveVersion) else None
+        if version is None:
+            self._misses += 1
+            return await query(self._encode, build)
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._hits += 1
+            return entry
+        pending = self._pending.get(key)
+        if pending is not None:
+            # Concurrent requests for the same missing entry share one build.
+            self._hits += 1
+            return await asyncio.shield(pending)
+        self._misses += 1
+        pending = self._pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            entry = await query(self._encode, build)
+        except Exception as exception:
+            pending.set_exception(exception)
+            # Waiters, if any, re-raise it; without them the future would log it as never retrieved.
+            pending.exception()
+            raise
+        else:
+            pending.set_result(entry)
+        finally:
+            del self._pending[key]
+        if self._version == version:
+            if len(self._entries) >= self._max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._entries[key] = entry
+        return entry
+
+    async def respond(self, request: web.Request, build: Callable[[], Any]) -> web.Response:
+        """ BUILD returns the value to send: a JSON string, bytes or anything json.dumps takes """
+        entry = await self._get(request.path_qs, build)
+        headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and (if_none_match.strip() == '*' or entry.etag in
+                                          (etag.strip().removeprefix('W/') for etag in if_none_match.split(','))):
+            self._not_modified += 1
+            return web.Response(status=304, headers=headers)
+        if entry.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            return web.Response(body=entry.gzipped, headers=headers, content_type='application/json')
+        return web.Response(body=entry.body, headers=headers, content_type='application/json')
+
+    def clear(self):
+        self._entries.clear()
+        self._version = None
+
+    def stats(self) -> dict:
+        return {'version': self._version, 'entries': len(self._entries), 'hits': self._hits,
+                'misses': self._misses, 'not_modified': self._not_modified,
+                'bytes': sum(len(entry.body) + len(entry.gzipped or b'') for entry in self._entries.values())}
+
+
+response_cache = ResponseCache()
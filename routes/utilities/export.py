@@ -0,0 +1,53 @@
+import json
+from typing import Iterator, Tuple
+
+from routes.utilities.selector import RowQuery
+
+# Rows encoded per chunk: each chunk is one executor call and one write to the client.
+CHUNK_ROWS = 5000
+
+
+class Export:
+    """ Rows of ROW_QUERY encoded CHUNK_ROWS at a time, as NDJSON lines or as one JSON array.
+
+    Only the chunk being encoded is in memory, rows are pulled from the storage iterator as the
+    client reads them """
+
+    def __init__(self, row_query: RowQuery, ndjson: bool = True):
+        self._row_query = row_query
+        self._ndjson = ndjson
+        self._rows: Iterator[Tuple[str, int, str, bool]] = row_query.records()
+        self._started = False
+        self._done = False
+        self.count = 0
+
+    @property
+    def content_type(self) -> str:
+        return 'application/x-ndjson' if self._ndjson else 'application/json'
+
+    def chunk(self) -> bytes:
+        """ The next part of the body, b'' once everything has been returned """
+        if self._done:
+            return b''
+        lines = list()
+        for row in self._rows:
+            lines.append(json.dumps(self._row_query.project(row)))
+            if len(lines) == CHUNK_ROWS:
+                break
+        else:
+            self._done = True
+        self.count += len(lines)
+        if self._ndjson:
+            return ''.join(line + '\n' for line in lines).encode()
+        body = ',\n'.join(lines)
+        if self._started and lines:
+            body = ',\n' + body
+        if not self._started:
+            body = '[' + body
+        self._started = True
+        return (body + (']\n' if self._done else '')).encode()
+
+    def close(self):
+        """ Stops the storage iterator, which releases whatever it holds open """
+        self._done = True
+        self._rows.close()
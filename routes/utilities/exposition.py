@@ -0,0 +1,77 @@
+from typing import Callable, Optional
+
+from events import event_bus
+from routes.utilities.cache import response_cache
+from storage import storage, IngestQueue, IHaveSize, IHaveVersion
+from telemetry import registry
+
+# State the program keeps anyway, read when /metrics is scraped: no storage tree is walked.
+
+
+def _hosts_up():
+    for address, state in event_bus.states().items():
+        yield (address,), int(state.alive)
+
+
+def _hosts_rtt():
+    for address, state in event_bus.states().items():
+        if state.rtt is not None:
+            yield (address,), state.rtt
+
+
+def _storage_bytes():
+    if isinstance(storage.storage, IHaveSize):
+        yield (), storage.storage.nbytes
+
+
+def _storage_version():
+    if isinstance(storage.storage, IHaveVersion):
+        yield (), storage.storage.version
+
+
+def _ingest_stats() -> Optional[dict]:
+    return storage.observer.stats() if isinstance(storage.observer, IngestQueue) else None
+
+
+def _stat(stats: Callable[[], Optional[dict]], name: str):
+    """ Collector of one value of a stats() dict, nothing while STATS returns None """
+    def collect():
+        values = stats()
+        if values is not None:
+            yield (), values[name]
+    return collect
+
+
+registry.callback('nmf_host_up', 'Last probe result of the host, 1 when it answered', _hosts_up, ('address',))
+registry.callback('nmf_host_rtt_milliseconds', 'Average RTT of the last probe of the host', _hosts_rtt, ('address',))
+registry.callback('nmf_storage_bytes', 'Memory or disk the stored samples take', _storage_bytes)
+registry.callback('nmf_storage_version', 'Storage version, changes on every write', _storage_version)
+
+# Running totals are counters, current levels are gauges; each gets a metric of its own.
+for name, help_, stats, key, kind in (
+        ('nmf_ingest_depth', 'Results waiting in the ingest queue', _ingest_stats, 'depth', 'gauge'),
+        ('nmf_ingest_max_depth', 'Deepest the ingest queue has been', _ingest_stats, 'max_depth', 'gauge'),
+        ('nmf_ingest_max_lag_seconds', 'Longest a result waited in the ingest queue', _ingest_stats, 'max_lag',
+         'gauge'),
+        ('nmf_ingest_received_total', 'Results handed to the ingest queue', _ingest_stats, 'received', 'counter'),
+        ('nmf_ingest_written_total', 'Results written to storage', _ingest_stats, 'written', 'counter'),
+        ('nmf_ingest_batches_total', 'add_data calls made by the ingest queue', _ingest_stats, 'batches', 'counter'),
+        ('nmf_ingest_overflows_total', 'Results that found the ingest queue full', _ingest_stats, 'overflows',
+         'counter'),
+        ('nmf_events_hosts', 'Hosts the event bus knows the state of', event_bus.stats, 'hosts', 'gauge'),
+        ('nmf_events_published_total', 'Events published on the event bus', event_bus.stats, 'published', 'counter'),
+        ('nmf_events_subscribers', 'Event bus subscriptions', event_bus.stats, 'subscribers', 'gauge'),
+        ('nmf_events_queued', 'Events waiting in subscriber queues', event_bus.stats, 'queued', 'gauge'),
+        ('nmf_events_dropped', 'Events the current subscribers dropped', event_bus.stats, 'dropped', 'gauge'),
+        ('nmf_response_cache_entries', 'Cached /api/nmf responses', response_cache.stats, 'entries', 'gauge'),
+        ('nmf_response_cache_bytes', 'Bytes of cached /api/nmf responses', response_cache.stats, 'bytes', 'gauge'),
+        ('nmf_response_cache_hits_total', 'Responses served from the cache', response_cache.stats, 'hits', 'counter'),
+        ('nmf_response_cache_misses_total', 'Responses built for the cache', response_cache.stats, 'misses',
+         'counter'),
+        ('nmf_response_cache_not_modified_total', 'Requests answered 304 Not Modified', response_cache.stats,
+         'not_modified', 'counter')):
+    registry.callback(name, help_, _stat(stats, key), kind=kind)
+
+
+def render() -> str:
+    return registry.render()
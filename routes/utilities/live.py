@@ -0,0 +1,59 @@
+import asyncio
+import json
+from typing import Mapping, Optional, List, Callable, Awaitable
+
+from events import Subscription, event_bus
+from sample import current_timestamp
+
+# Events a live client may have queued before it is disconnected as too slow.
+LIVE_QUEUE = 1000
+# Seconds one send may wait for the client to read before it is disconnected.
+SEND_TIMEOUT = 10.0
+
+SNAPSHOT_FIELDS = ('is_alive', 'since', 'rtt')
+
+Send = Callable[[Optional[str], str], Awaitable[None]]
+
+
+def _values(filters: Mapping, name: str) -> Optional[List[str]]:
+    """ A filter from the query string ('a,b') or from a JSON message (['a', 'b'] or 'a,b') """
+    value = filters.get(name)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [item for item in value.split(',') if item]
+    return [str(item) for item in value]
+
+
+def subscribe(filters: Mapping) -> Subscription:
+    """ Subscription for the topics, hosts and groups filters; ValueError for unknown ones """
+    return event_bus.subscribe(topics=_values(filters, 'topics'), hosts=_values(filters, 'hosts'),
+                               groups=_values(filters, 'groups'), maxsize=LIVE_QUEUE, disconnect=True)
+
+
+def snapshot(subscription: Subscription) -> str:
+    """ Current state of every watched host as {address: [is_alive, since, rtt]} """
+    hosts = {address: [int(state.alive), state.since, state.rtt] for address, state in event_bus.states().items()
+             if subscription.watches(address)}
+    return json.dumps({'event': 'snapshot', 'time': current_timestamp(), 'fields': SNAPSHOT_FIELDS, 'hosts': hosts})
+
+
+async def push(subscription: Subscription, send: Send, keepalive: float = None) -> bool:
+    """ The snapshot, then every event of SUBSCRIPTION until it is closed. SEND(None, '') is called
+    after KEEPALIVE idle seconds. False when the client was too slow: its queue overflowed or a
+    send took longer than SEND_TIMEOUT """
+    try:
+        await asyncio.wait_for(send('snapshot', snapshot(subscription)), SEND_TIMEOUT)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), keepalive)
+            except asyncio.TimeoutError:
+                await asyncio.wait_for(send(None, ''), SEND_TIMEOUT)
+                continue
+            if event is None:
+                return not subscription.overflowed
+            await asyncio.wait_for(send(event.topic, json.dumps(event.as_dict())), SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        subscription.close()
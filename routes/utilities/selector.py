@@ -1,18 +1,157 @@
+import asyncio
+import base64
+import heapq
+import json
+from typing import Mapping, Optional, List, Tuple, Iterator
+
 from aiohttp import web
 
-from storage import storage
+from sample import is_alive, current_timestamp
+from storage import storage, IBlockingStorage, IHaveRange, IHaveRecords, IHaveRows, IHavePath
+from storage.storage import limit_range, walk
+from targets import AddressSet
+
 
+async def query(function, *args):
+    """ Run a storage read off the event loop when the backend blocks on I/O """
+    if isinstance(storage.storage, IBlockingStorage):
+        return await asyncio.get_running_loop().run_in_executor(storage.storage.executor, function, *args)
+    return function(*args)
 
-def selector(values: list):
-    if len(list(filter(lambda v: v is not None, values))) == 0:
+
+def navigate(values: list):
+    """ Path segments walk the storage tree: the first one goes through get_data, so it may be a service,
+    a timestamp or an address, each next one indexes what the previous returned. Storages with IHavePath
+    look the path up without building the subtrees it passes through """
+    values = [value.replace('\'', '') for value in values if value is not None]
+    if not values:
         return storage.storage.get_data()
-    elif values[4] is not None:
-        return storage.storage.get_data(values[4])
-    elif values[3] is not None:
-        return storage.storage.get_data(values[3])
-    elif values[2] is not None:
-        return storage.storage.get_data(values[2])
-    elif values[1] is not None:
-        return storage.storage.get_data(values[1])
-    elif values[0] is not None:
-        return storage.storage.get_data(values[0])
+    if isinstance(storage.storage, IHavePath):
+        return storage.storage.get_path(values)
+    return walk(storage.storage.get_data(values[0]), values[1:])
+
+
+def select_range(start: int = None, end: int = None, host: str = None, limit: int = None) -> dict:
+    """ Range query on the storage; backends without IHaveRange have their tree filtered here """
+    if isinstance(storage.storage, IHaveRange):
+        return storage.storage.get_range(start, end, host, limit)
+    result = dict()
+    for service, dates in storage.storage.get_data().items():
+        timestamps = sorted(timestamp for timestamp, hosts in dates.items() if host is None or host in hosts)
+        result[service] = {timestamp: dates[timestamp] if host is None else {host: dates[timestamp][host]}
+                           for timestamp in limit_range(timestamps, start, end, limit)}
+    return result
+
+
+def iter_records(start: int = None, end: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+    """ (service, timestamp, address, is_alive) rows; storages without IHaveRecords are read into a tree first """
+    if isinstance(storage.storage, IHaveRecords):
+        yield from storage.storage.records(start, end)
+        return
+    for service, dates in select_range(start, end).items():
+        for timestamp, hosts in dates.items():
+            for address, value in hosts.items():
+                yield service, timestamp, address, is_alive(value)
+
+
+FIELDS = ('service', 'time', 'address', 'is_alive')
+MAX_LIMIT = 10000
+
+
+def encode_cursor(service: str, timestamp: int, address: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([service, timestamp, address]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int, str]:
+    try:
+        service, timestamp, address = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(service), int(timestamp), str(address)
+    except (ValueError, TypeError):
+        raise ValueError('Неверный cursor')
+
+
+class RowQuery:
+    """ Flat (service, time, address, is_alive) rows of the storage, filtered, projected and paged.
+
+    Rows come in (service, time, address) order and CURSOR is the key of the last row of the previous
+    page, so pages stay consistent while new cycles arrive. Storages with IHaveRows read a page from the
+    cursor on; the other filters are applied to what they return """
+
+    def __init__(self, **kwargs):
+        hosts = kwargs.get('hosts')
+        self.hosts: Optional[AddressSet] = AddressSet(hosts) if hosts else None
+        # A single address is handed to the storage, which has an index for it.
+        self.host: Optional[str] = hosts[0] if hosts and len(self.hosts) == 1 and hosts[0] in self.hosts else None
+        self.services: Optional[List[str]] = kwargs.get('services')
+        self.state: Optional[bool] = kwargs.get('state')
+        self.start: Optional[int] = kwargs.get('start')
+        self.end: Optional[int] = kwargs.get('end')
+        self.fields: Tuple[str, ...] = tuple(kwargs.get('fields') or FIELDS)
+        self.limit: int = kwargs.get('limit', 1000)
+        self.cursor: Optional[Tuple[str, int, str]] = kwargs.get('cursor')
+
+    @classmethod
+    def from_params(cls, params: Mapping) -> 'RowQuery':
+        """ ?host=10.1.0.0/16,10.2.0.1&service=&state=up|down&from=&to=&last=&fields=&limit=&cursor=;
+        ValueError on anything malformed """
+        def values(name: str) -> Optional[List[str]]:
+            return [value for value in params[name].split(',') if value] if name in params else None
+
+        def number(name: str) -> Optional[int]:
+            try:
+                return int(params[name]) if name in params else None
+            except ValueError:
+                raise ValueError(f'{name} должен быть целым числом')
+
+        state = params.get('state')
+        if state not in (None, 'up', 'down'):
+            raise ValueError('state должен быть up или down')
+        fields = values('fields')
+        unknown = [field for field in fields or () if field not in FIELDS]
+        if unknown:
+            raise ValueError(f'Неизвестные поля: {", ".join(unknown)}')
+        start, last = number('from'), number('last')
+        if last is not None:
+            start = max(start or 0, current_timestamp() - last)
+        limit = number('limit')
+        limit = 1000 if limit is None else limit
+        if not 0 < limit <= MAX_LIMIT:
+            raise ValueError(f'limit должен быть от 1 до {MAX_LIMIT}')
+        hosts = values('host')
+        if hosts:
+            # Parsed here so a malformed range is a bad request and not a failed query.
+            AddressSet(hosts)
+        return cls(hosts=hosts, services=values('service'), state=None if state is None else state == 'up',
+                   start=start, end=number('to'), fields=fields, limit=limit,
+                   cursor=decode_cursor(params['cursor']) if 'cursor' in params else None)
+
+    def _rows(self) -> Iterator[Tuple[str, int, str, bool]]:
+        if isinstance(storage.storage, IHaveRows):
+            rows = storage.storage.rows(self.start, self.end, self.cursor, self.services, self.host)
+            return (row for row in rows if self.accepts(row[0], row[2], row[3]))
+        # Without an ordered index one pass keeps just the page's smallest keys after the cursor.
+        rows = (row for row in iter_records(self.start, self.end) if self.accepts(row[0], row[2], row[3])
+                and (self.host is None or row[2] == self.host) and (self.cursor is None or row[:3] > self.cursor))
+        return iter(heapq.nsmallest(self.limit + 1, rows, key=lambda row: row[:3]))
+
+    def accepts(self, service: str, address: str, alive: bool) -> bool:
+        return (self.services is None or service in self.services) and \
+            (self.hosts is None or address in self.hosts) and (self.state is None or alive == self.state)
+
+    def project(self, row: Tuple[str, int, str, bool]) -> dict:
+        return dict(zip(self.fields, (row[FIELDS.index(field)] for field in self.fields)))
+
+    def run(self) -> dict:
+        items, last = list(), None
+        for row in self._rows():
+            if len(items) == self.limit:
+                return {'items': items, 'next': encode_cursor(*last[:3])}
+            items.append(self.project(row))
+            last = row
+        return {'items': items, 'next': None}
+
+    def records(self) -> Iterator[Tuple[str, int, str, bool]]:
+        """ Every matching row, unpaged and in storage order, read lazily where the storage can """
+        for row in iter_records(self.start, self.end):
+            if self.accepts(row[0], row[2], row[3]):
+                yield row
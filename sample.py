@@ -0,0 +1,83 @@
+import datetime
+from array import array
+from time import time
+from typing import NamedTuple, Union, Iterator, Tuple, List
+
+from icmplib import Host
+
+METRICS = ('avg_rtt', 'min_rtt', 'max_rtt', 'jitter', 'packet_loss')
+
+
+class ProbeSample(NamedTuple):
+    is_alive: bool
+    avg_rtt: float = 0.0
+    min_rtt: float = 0.0
+    max_rtt: float = 0.0
+    jitter: float = 0.0
+    packet_loss: float = 1.0
+
+    @classmethod
+    def from_host(cls, host: Host) -> 'ProbeSample':
+        return cls(host.is_alive, host.avg_rtt, host.min_rtt, host.max_rtt, host.jitter, host.packet_loss)
+
+    @property
+    def metrics(self) -> Tuple[float, ...]:
+        return self[1:]
+
+
+def is_alive(value: Union[ProbeSample, bool]) -> bool:
+    return value.is_alive if isinstance(value, ProbeSample) else bool(value)
+
+
+def parse_timestamp(key: Union[str, int, float]) -> int:
+    """ Epoch seconds for a storage key: an int, its string form or a legacy 'd.m.Y H.M' key """
+    if isinstance(key, (int, float)):
+        return int(key)
+    if key.isdigit():
+        return int(key)
+    return int(datetime.datetime.strptime(key, '%d.%m.%Y %H.%M').timestamp())
+
+
+_last_timestamp = 0
+
+
+def current_timestamp() -> int:
+    """ Epoch seconds for a new result; never goes backwards, even when the wall clock does """
+    global _last_timestamp
+    _last_timestamp = max(_last_timestamp, int(time()))
+    return _last_timestamp
+
+
+def iter_samples(value: dict) -> Iterator[Tuple[str, str, str, Union[ProbeSample, bool]]]:
+    """ (service, timestamp, address, sample) for every leaf of {service: {timestamp: {address: sample}}} """
+    for service, dates in value.items():
+        if not isinstance(dates, dict):
+            continue
+        for date, hosts in dates.items():
+            if not isinstance(hosts, dict):
+                continue
+            for address, sample in hosts.items():
+                yield service, date, address, sample
+
+
+class MetricsBuffer:
+    """ Fixed-width float32 records per host: a timestamp column and len(METRICS) values per sample """
+    __slots__ = 'timestamps', 'values'
+
+    RECORD_SIZE = array('l').itemsize + len(METRICS) * array('f').itemsize
+
+    def __init__(self):
+        self.timestamps = array('l')
+        self.values = array('f')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp: int, sample: ProbeSample):
+        self.timestamps.append(timestamp)
+        self.values.extend(sample.metrics)
+
+    def records(self) -> List[dict]:
+        width = len(METRICS)
+        return [dict(time=timestamp, **dict(zip(METRICS, self.values[index * width:(index + 1) * width])))
+                for index, timestamp in enumerate(self.timestamps)]
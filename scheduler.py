@@ -0,0 +1,171 @@
+import asyncio
+import heapq
+from abc import ABC, abstractmethod
+from itertools import count
+from time import monotonic
+from typing import Dict, List, Tuple, Optional, Hashable
+
+
+class IScheduler(ABC):
+    @abstractmethod
+    def add(self, host: Hashable, critical: bool = False):
+        pass
+
+    @abstractmethod
+    def remove(self, host: Hashable):
+        pass
+
+    @abstractmethod
+    def due(self, now: float = None) -> List[Hashable]:
+        pass
+
+    @abstractmethod
+    def lease(self, host: Hashable, now: float = None):
+        pass
+
+    @abstractmethod
+    def is_critical(self, host: Hashable) -> bool:
+        pass
+
+    @abstractmethod
+    def report(self, host: Hashable, is_alive: bool, now: float = None):
+        pass
+
+    @abstractmethod
+    async def wait(self):
+        pass
+
+
+class _HostState:
+    __slots__ = 'due', 'is_alive', 'down_count', 'confirm', 'critical'
+
+    def __init__(self, due: float, critical: bool):
+        self.due = due
+        self.is_alive: Optional[bool] = None
+        self.down_count = 0
+        self.confirm = 0
+        self.critical = critical
+
+
+class ProbeScheduler(IScheduler):
+    """ Heap of per-host due times: dead hosts back off, state changes are re-probed quickly """
+
+    def __init__(self, **kwargs):
+        self._interval: float = kwargs.get('interval', 30.0)
+        self._critical_interval: float = kwargs.get('critical_interval', self._interval / 6)
+        self._confirm_interval: float = kwargs.get('confirm_interval', 2.0)
+        self._confirm_probes: int = kwargs.get('confirm_probes', 2)
+        self._backoff_after: int = kwargs.get('backoff_after', 3)
+        self._backoff_factor: float = kwargs.get('backoff_factor', 2.0)
+        self._max_interval: float = kwargs.get('max_interval', 600.0)
+        # A host handed out by due() is leased until report(); if the report
+        # never comes it is probed again once the lease runs out. lease() renews it
+        # when a worker actually takes the host.
+        self._lease: float = kwargs.get('lease', self._interval)
+        # The counter breaks ties so hosts themselves (ints and hostnames) are never compared.
+        self._heap: List[Tuple[float, int, Hashable]] = list()
+        self._order = count()
+        self._hosts: Dict[Hashable, _HostState] = dict()
+        self._changed: Optional[asyncio.Event] = None
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __contains__(self, host: Hashable):
+        return host in self._hosts
+
+    def __iter__(self):
+        return iter(self._hosts)
+
+    def _push(self, host: Hashable, state: _HostState, due: float):
+        state.due = due
+        heapq.heappush(self._heap, (due, next(self._order), host))
+
+    def _wake(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    def add(self, host: Hashable, critical: bool = False):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(monotonic(), critical)
+            self._push(host, state, state.due)
+            self._wake()
+        else:
+            state.critical = critical
+
+    def remove(self, host: Hashable):
+        # Heap entries of removed hosts are dropped lazily in due().
+        self._hosts.pop(host, None)
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            due, _, host = self._heap[0]
+            state = self._hosts.get(host)
+            if state is not None and state.due == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def due(self, now: float = None) -> List[Hashable]:
+        now = monotonic() if now is None else now
+        hosts = list()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, host = heapq.heappop(self._heap)
+            state = self._hosts.get(host)
+            if state is None or state.due != due:
+                continue
+            self._push(host, state, now + self._lease)
+            hosts.append(host)
+        return hosts
+
+    def lease(self, host: Hashable, now: float = None):
+        """ Renew the lease of a host handed out by due(), counting from NOW """
+        state = self._hosts.get(host)
+        if state is not None:
+            self._push(host, state, (monotonic() if now is None else now) + self._lease)
+
+    def is_critical(self, host: Hashable) -> bool:
+        state = self._hosts.get(host)
+        return state is not None and state.critical
+
+    def _next_interval(self, state: _HostState, is_alive: bool) -> float:
+        if state.is_alive is not None and state.is_alive != is_alive:
+            state.confirm = self._confirm_probes
+        if is_alive:
+            state.down_count = 0
+        else:
+            state.down_count += 1
+
+        if state.confirm > 0:
+            state.confirm -= 1
+            return self._confirm_interval
+        if state.critical:
+            return self._critical_interval
+        if state.down_count > self._backoff_after:
+            backoff = self._backoff_factor ** (state.down_count - self._backoff_after)
+            return min(self._interval * backoff, self._max_interval)
+        return self._interval
+
+    def report(self, host: Hashable, is_alive: bool, now: float = None):
+        state = self._hosts.get(host)
+        if state is None:
+            return
+        now = monotonic() if now is None else now
+        interval = self._next_interval(state, is_alive)
+        state.is_alive = is_alive
+        self._push(host, state, now + interval)
+
+    async def wait(self):
+        """ Sleep until the earliest host is due, or until a new host is added """
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        self._changed.clear()
+        next_due = self.next_due()
+        timeout = self._interval if next_due is None else next_due - monotonic()
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from abc import ABC, abstractmethod
 
@@ -11,6 +12,7 @@ from route import IHaveHTTPRoute, IHaveAPIRoute, APIHaveRoute, HTTPHaveRoute
 from routes import router
 from service import DefaultServiceFacade
 from storage import IHaveStorage, IStorage
+from telemetry import watch_loop_lag
 
 
 class IServer(DefaultServiceFacade, ABC):
@@ -67,6 +69,7 @@ class HTTPServer(DefaultServer, IHaveHTTPRoute, IHaveAPIRoute):
         self._api: APIHaveRoute = kwargs.get('api')
         self._port = kwargs.get('port', 8080)
         self._host = kwargs.get('host', '127.0.0.1')
+        self._loop_lag = None
         self.app = web.Application()
         aiohttp_jinja2.setup(
             self.app, loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -111,4 +114,6 @@ class HTTPServer(DefaultServer, IHaveHTTPRoute, IHaveAPIRoute):
         site_ = web.TCPSite(runner_, self._host, self._port)
         await site_.start()
         logger.info(f"Serving up app on {self._host}:{self._port}")
+        if self._loop_lag is None:
+            self._loop_lag = asyncio.ensure_future(watch_loop_lag())
         return runner_, site_
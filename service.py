@@ -1,15 +1,22 @@
 import asyncio
 from abc import ABC, abstractmethod
-from typing import Union, List, Tuple
-import datetime
-
-from icmplib import async_multiping
+from typing import Dict, Optional
 
 from device import IHaveDevice
-from result import IResult
+from probe import IProbeEngine, probe_engine
+from result import IResult, CycleResult
+from sample import ProbeSample, current_timestamp
+from scheduler import IScheduler, ProbeScheduler
 from status import IStatus, StopStatus, StartStatus, RestartStatus
-from storage.storage import IStorage, IHaveStorage
+from storage.storage import IStorage, IHaveStorage, IBlockingStorage, ICompactableStorage, IHaveAsyncCompaction, \
+    IHaveSnapshot
 from subject import DefaultSubjectFacade
+from targets import Address, parse_targets, to_str
+from telemetry import registry
+from work_queue import IWorkQueue, IHaveWorkQueue, WorkStealingQueue
+
+CYCLE_SECONDS = registry.histogram('nmf_cycle_seconds', 'Time a probe service takes to probe one batch of hosts',
+                                   ('service', 'worker'), (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
 
 
 class IHaseTimeout(ABC):
@@ -140,34 +147,90 @@ class DefaultServiceFacade(IService, DefaultSubjectFacade, DefaultHaseTimeout):
         return self._timeout
 
 
-class SearchDeviceService(DefaultServiceFacade, IHaveDevice):
+class SearchDeviceService(DefaultServiceFacade, IHaveDevice, IHaveWorkQueue):
     def __init__(self, **kwargs):
-        self._devices: Union[List, Tuple] = kwargs.pop('devices', list())
+        devices = kwargs.pop('devices', list())
+        self._probe_engine: IProbeEngine = kwargs.pop('probe_engine', probe_engine)
+        self._stream: bool = kwargs.pop('stream', False)
+        self._work_queue: IWorkQueue = kwargs.pop('work_queue', None)
+        scheduler: IScheduler = kwargs.pop('scheduler', None)
         super().__init__(name='NetworkManager', **kwargs)
+        if self._work_queue is None:
+            if scheduler is None:
+                scheduler = ProbeScheduler(interval=self.timeout)
+            self._work_queue = WorkStealingQueue(scheduler=scheduler)
+        self._register()
+        for device in devices:
+            self.add_device(device)
+
+    def set_work_queue(self, work_queue: IWorkQueue) -> IService and IHaveWorkQueue:
+        if work_queue is self._work_queue:
+            return self
+        previous = self._work_queue
+        previous.unregister(self._worker)
+        self._work_queue = work_queue
+        self._register()
+        for device in list(previous):
+            work_queue.add(device, critical=previous.is_critical(device))
+        return self
+
+    def _register(self):
+        """ Join the work queue; every service is named NetworkManager, so cycle times are told apart by the
+        worker id the queue hands out """
+        self._worker: int = self._work_queue.register()
+        self._cycle_seconds = CYCLE_SECONDS.labels(self.name, str(self._worker))
+
+    def get_work_queue(self) -> IWorkQueue:
+        return self._work_queue
 
-    def add_device(self, device: str):
-        self._devices.append(device)
+    def add_device(self, device: str, critical: bool = False):
+        for address in parse_targets(device):
+            self._work_queue.add(address, critical=critical)
 
     def del_device(self, device: str):
-        self._devices.remove(device)
+        for address in parse_targets(device):
+            self._work_queue.remove(address)
+
+    @staticmethod
+    def _date() -> int:
+        return current_timestamp()
+
+    async def _work_stream(self, devices: Dict[str, Address]):
+        date = self._date()
+        async for result_ping in self._probe_engine.stream(devices):
+            self._work_queue.report(devices[result_ping.address], result_ping.is_alive)
+            result = CycleResult(self.name, date, {result_ping.address: ProbeSample.from_host(result_ping)})
+            self.set_result(result)
+            self.notify(result)
+
+    async def _work(self, *args, **kwargs) -> Optional[CycleResult]:
+        """ The cycle to hand to observers, None when there is none: the batch was empty or, when
+        streaming, its results were already pushed host by host """
+        devices = {to_str(address): address for address in await self._work_queue.get(self._worker)}
+        if len(devices) == 0:
+            return None
+        if self._stream:
+            with self._cycle_seconds.time():
+                await self._work_stream(devices)
+            return None
+        with self._cycle_seconds.time():
+            results_raw = await self._probe_engine.probe(devices)
+        samples = dict()
+        for result_ping in results_raw:
+            self._work_queue.report(devices[result_ping.address], result_ping.is_alive)
+            samples[result_ping.address] = ProbeSample.from_host(result_ping)
+        result = CycleResult(self.name, self._date(), samples)
+        self.set_result(result)
+        return result
 
-    async def _work(self, *args, **kwargs):
-        if isinstance(self._devices, tuple):
-            self._devices = list(self._devices)
-        try:
-            results_raw = await async_multiping(self._devices)
-            raw_date = datetime.datetime.now()
-            date = f'{raw_date.day}.{raw_date.month}.{raw_date.year} {raw_date.hour}.{raw_date.minute}'
-            results_final = {self.name: {date: dict()}}
-            results_final_with_name = results_final[self.name]
-            results_final_with_name_with_date = results_final_with_name[date]
-
-            for result_ping in results_raw:
-                results_final_with_name_with_date.update({result_ping.address: result_ping.is_alive})
-            self.set_result(results_final)
-            await self.sleep()
-        except ValueError:
-            await asyncio.sleep(30)
+    async def work(self, *args, **kwargs):
+        while self._status_start.get_state():
+            try:
+                result = await self._work(*args, **kwargs)
+                if result is not None:
+                    self.notify(result)
+            except TypeError:
+                pass
 
 
 class PrintService(DefaultServiceFacade, IHaveStorage):
@@ -184,7 +247,17 @@ class PrintService(DefaultServiceFacade, IHaveStorage):
         return self._storage
 
     async def _work(self, *args, **kwargs):
-        data = self._storage.get_data()
+        if isinstance(self._storage, IHaveSnapshot):
+            # The text of a version is built once, however many times it is printed.
+            snapshot = self._storage.snapshot()
+            if len(snapshot.data) != 0:
+                print(snapshot.view('str', str))
+            await self.sleep()
+            return
+        if isinstance(self._storage, IBlockingStorage):
+            data = await asyncio.get_running_loop().run_in_executor(self._storage.executor, self._storage.get_data)
+        else:
+            data = self._storage.get_data()
         if len(data) != 0:
             print(data)
         await self.sleep()
@@ -195,3 +268,36 @@ class PrintService(DefaultServiceFacade, IHaveStorage):
                 await self._work(*args, **kwargs)
             except TypeError:
                 pass
+
+
+class CompactionService(DefaultServiceFacade, IHaveStorage):
+    """ Calls compact() on the storage every TIMEOUT seconds when the backend supports it """
+    def __init__(self, storage=None, **kwargs):
+        super().__init__(name='CompactionService', **kwargs)
+        self._storage: IStorage = storage
+        self._timeout: float = kwargs.get('timeout', 60.0)
+
+    def set_storage(self, storage: IStorage) -> IService and IHaveStorage:
+        self._storage = storage
+        return self
+
+    def get_storage(self) -> IStorage:
+        return self._storage
+
+    async def _work(self, *args, **kwargs):
+        await self.sleep()
+        if isinstance(self._storage, IHaveAsyncCompaction):
+            await self._storage.compact_async()
+        elif not isinstance(self._storage, ICompactableStorage):
+            return
+        elif isinstance(self._storage, IBlockingStorage):
+            await asyncio.get_running_loop().run_in_executor(self._storage.executor, self._storage.compact)
+        else:
+            self._storage.compact()
+
+    async def work(self, *args, **kwargs):
+        while self._status_start.get_state():
+            try:
+                await self._work(*args, **kwargs)
+            except TypeError:
+                pass
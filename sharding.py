@@ -0,0 +1,239 @@
+import asyncio
+import multiprocessing
+import os
+from array import array
+from multiprocessing.connection import Connection
+from typing import List, Iterator, Tuple, NamedTuple
+
+from loguru import logger
+
+from device import IHaveDevice
+from probe import ICMPProbeEngine
+from result import CycleResult
+from sample import METRICS, ProbeSample
+from scheduler import ProbeScheduler
+from service import DefaultServiceFacade, SearchDeviceService
+from targets import Address, IPV6_FLAG, parse_targets, to_str
+from work_queue import WorkStealingQueue
+
+
+class ShardBatch:
+    """ Results of one shard flush: IPv4 hosts as parallel arrays, the rest as tuples """
+    __slots__ = 'addresses', 'states', 'metrics', 'others'
+
+    def __init__(self):
+        self.addresses = array('I')
+        self.states = bytearray()
+        self.metrics = array('f')
+        self.others: List[Tuple[Address, ProbeSample]] = list()
+
+    def __len__(self):
+        return len(self.addresses) + len(self.others)
+
+    def append(self, address: Address, sample: ProbeSample):
+        if isinstance(address, int) and not address & IPV6_FLAG:
+            self.addresses.append(address)
+            self.states.append(sample.is_alive)
+            self.metrics.extend(sample.metrics)
+        else:
+            self.others.append((address, sample))
+
+    def pack(self) -> tuple:
+        return self.addresses.tobytes(), bytes(self.states), self.metrics.tobytes(), self.others
+
+    @staticmethod
+    def unpack(message: tuple) -> Iterator[Tuple[Address, ProbeSample]]:
+        addresses_raw, states, metrics_raw, others = message
+        addresses, metrics = array('I'), array('f')
+        addresses.frombytes(addresses_raw)
+        metrics.frombytes(metrics_raw)
+        width = len(METRICS)
+        for index, (address, state) in enumerate(zip(addresses, states)):
+            yield address, ProbeSample(bool(state), *metrics[index * width:(index + 1) * width])
+        yield from others
+
+
+async def _recv(connection: Connection):
+    """ Next message of CONNECTION, awaited on the event loop so no executor thread is held by an idle pipe """
+    if not connection.poll():
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fileno = connection.fileno()
+        loop.add_reader(fileno, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fileno)
+    return connection.recv()
+
+
+class _Shard:
+    def __init__(self, commands: Connection, results: Connection, **kwargs):
+        self._commands = commands
+        self._results = results
+        self._engine = ICMPProbeEngine(**kwargs.get('engine', dict()))
+        self._work_queue = WorkStealingQueue(scheduler=ProbeScheduler(interval=kwargs.get('interval', 30.0)))
+        self._workers: int = kwargs.get('workers', 4)
+        self._flush_interval: float = kwargs.get('flush_interval', 0.5)
+        self._batch = ShardBatch()
+
+    async def _read_commands(self):
+        while True:
+            try:
+                command, *args = await _recv(self._commands)
+            except EOFError:
+                return
+            if command == 'add':
+                addresses, critical = args
+                for address in addresses:
+                    self._work_queue.add(address, critical=critical)
+            elif command == 'del':
+                for address in args[0]:
+                    self._work_queue.remove(address)
+            elif command == 'stop':
+                return
+
+    async def _probe(self):
+        worker = self._work_queue.register()
+        while True:
+            devices = {to_str(address): address for address in await self._work_queue.get(worker)}
+            async for result_ping in self._engine.stream(devices):
+                address = devices[result_ping.address]
+                self._work_queue.report(address, result_ping.is_alive)
+                self._batch.append(address, ProbeSample.from_host(result_ping))
+
+    def _flush(self):
+        if len(self._batch) != 0:
+            batch, self._batch = self._batch, ShardBatch()
+            self._results.send(batch.pack())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            self._flush()
+
+    async def run(self):
+        tasks = [asyncio.ensure_future(self._probe()) for _ in range(self._workers)]
+        tasks.append(asyncio.ensure_future(self._flush_periodically()))
+        try:
+            await self._read_commands()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._engine.close()
+            self._flush()
+            self._results.close()
+
+
+def _shard_main(commands: Connection, results: Connection, kwargs: dict):
+    asyncio.run(_Shard(commands, results, **kwargs).run())
+
+
+class _ShardProcess(NamedTuple):
+    process: multiprocessing.Process
+    commands: Connection
+    results: Connection
+
+
+class ShardedSearchDeviceService(DefaultServiceFacade, IHaveDevice):
+    """ Probing runs in PROCESSES child processes, each with its own engine and shard of targets;
+    batched results come back over pipes and are notified from the parent """
+
+    def __init__(self, **kwargs):
+        self._processes: int = kwargs.pop('processes', os.cpu_count() or 1)
+        self._shard_kwargs = dict(interval=kwargs.get('timeout', 10.0),
+                                  workers=kwargs.pop('workers', 4),
+                                  flush_interval=kwargs.pop('flush_interval', 0.5),
+                                  engine=dict(kwargs.pop('engine', dict())))
+        super().__init__(name='NetworkManager', **kwargs)
+        # Rate limits are process-wide budgets, so every shard gets its share.
+        engine = self._shard_kwargs['engine']
+        for key in ('pps', 'subnet_pps'):
+            if engine.get(key) is not None:
+                engine[key] = engine[key] / self._processes
+        self._shards: List[_ShardProcess] = list()
+        self._pending: List[list] = [list() for _ in range(self._processes)]
+
+    def _shard(self, address: Address) -> int:
+        return hash(address) % self._processes
+
+    def _command(self, shard: int, command: tuple):
+        if self._shards:
+            self._shards[shard].commands.send(command)
+        else:
+            self._pending[shard].append(command)
+
+    def _group(self, device) -> List[List[Address]]:
+        groups = [list() for _ in range(self._processes)]
+        for address in parse_targets(device):
+            groups[self._shard(address)].append(address)
+        return groups
+
+    def add_device(self, device: str, critical: bool = False):
+        for shard, addresses in enumerate(self._group(device)):
+            if addresses:
+                self._command(shard, ('add', addresses, critical))
+
+    def del_device(self, device: str):
+        for shard, addresses in enumerate(self._group(device)):
+            if addresses:
+                self._command(shard, ('del', addresses))
+
+    async def _work(self, *args, **kwargs):
+        pass
+
+    def _start_shards(self):
+        context = multiprocessing.get_context('spawn')
+        for index in range(self._processes):
+            commands_reader, commands_writer = context.Pipe(duplex=False)
+            results_reader, results_writer = context.Pipe(duplex=False)
+            process = context.Process(target=_shard_main, args=(commands_reader, results_writer, self._shard_kwargs),
+                                      name=f'{self.name}-{index}', daemon=True)
+            process.start()
+            results_writer.close()
+            commands_reader.close()
+            self._shards.append(_ShardProcess(process, commands_writer, results_reader))
+        for shard, commands in enumerate(self._pending):
+            for command in commands:
+                self._command(shard, command)
+            commands.clear()
+        logger.info(f'Процессы опроса запущены: {self._processes}')
+
+    def _stop_shards(self):
+        for shard in self._shards:
+            try:
+                shard.commands.send(('stop',))
+            except OSError:
+                pass
+
+    def _join_shards(self):
+        for shard in self._shards:
+            shard.process.join(5)
+            if shard.process.is_alive():
+                shard.process.terminate()
+            shard.commands.close()
+        self._shards.clear()
+
+    async def _read_results(self, shard: _ShardProcess):
+        while self._status_start.get_state():
+            try:
+                message = await _recv(shard.results)
+            except (EOFError, OSError):
+                return
+            result = CycleResult(self.name, SearchDeviceService._date(),
+                                 {to_str(address): sample for address, sample in ShardBatch.unpack(message)})
+            self.set_result(result)
+            self.notify(result)
+
+    async def work(self, *args, **kwargs):
+        self._start_shards()
+        try:
+            await asyncio.gather(*(self._read_results(shard) for shard in self._shards))
+        finally:
+            self._stop_shards()
+            # Joining waits up to 5 seconds per shard, which the event loop must not.
+            await asyncio.get_running_loop().run_in_executor(None, self._join_shards)
+
+    async def stop(self):
+        await super().stop()
+        self._stop_shards()
@@ -1,4 +1,21 @@
 from storage.loader import storage
-from storage.storage import IHaveStorage, IStorage, IStorageFacade, IHaveStorageFacade
+from storage.ingest import IngestQueue
+from storage.log import ProbeLogStorage
+from storage.ring import RingBufferStorage
+from storage.rollup import RollupStorage
+from storage.sqlite import SQLiteStorage
+from storage.storage import IHaveStorage, IStorage, IStorageFacade, IHaveStorageFacade, IHaveMetrics, \
+    IHaveAvailability, IHaveRange, IHaveRecords, IHaveSnapshot, IHaveTransitions, IHaveVersion, ICompactableStorage, \
+    IHaveAsyncCompaction, IBlockingStorage, IHaveSize, IHaveRows, IHavePath, DefaultTreeStorage, Snapshot
+from storage.transitions import TransitionStorage
 
-__all__ = ['storage', 'IHaveStorage', 'IStorage', 'IStorageFacade', 'IHaveStorageFacade']
+try:
+    from storage.columnar import ColumnarStorage
+except ImportError:  # numpy is optional and only needed by the columnar backend
+    ColumnarStorage = None
+
+__all__ = ['storage', 'IHaveStorage', 'IStorage', 'IStorageFacade', 'IHaveStorageFacade', 'IHaveMetrics',
+           'IHaveAvailability', 'IHaveRange', 'IHaveRecords', 'IHaveSnapshot', 'IHaveTransitions', 'IHaveVersion',
+           'ICompactableStorage', 'IHaveAsyncCompaction', 'IBlockingStorage', 'IHaveSize', 'IHaveRows',
+           'IHavePath', 'DefaultTreeStorage', 'Snapshot', 'IngestQueue', 'RingBufferStorage', 'SQLiteStorage',
+           'ProbeLogStorage', 'RollupStorage', 'TransitionStorage', 'ColumnarStorage']
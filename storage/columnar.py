@@ -0,0 +1,265 @@
+from typing import Dict, List, Union, Optional, Tuple
+
+import numpy as np
+
+from sample import ProbeSample, iter_samples, parse_timestamp, is_alive
+from storage.storage import DefaultTreeStorage, IHaveMetrics, IHaveVersion, IHaveSize
+
+
+# Late results a sealed cycle keeps aside before they are merged into its columns.
+LATE_RESULTS = 256
+
+
+class Cycle:
+    """ One probe cycle, stored sparsely: the sorted ordinals of the probed hosts with their alive and
+    float32 RTT columns, so a worker's batch costs its own hosts whatever the size of the host set """
+    __slots__ = 'timestamp', 'ordinals', 'alive', 'rtt', 'late', '_open'
+
+    def __init__(self, timestamp: int):
+        self.timestamp = timestamp
+        self.ordinals = np.zeros(0, dtype=np.uint32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.rtt = np.zeros(0, dtype=np.float32)
+        # Results not in the columns yet: every one while the cycle is open, the late ones after it is sealed.
+        self.late: Dict[int, Tuple[bool, Optional[float]]] = dict()
+        self._open = True
+
+    def set(self, ordinal: int, sample: Union[ProbeSample, bool]):
+        rtt = sample.avg_rtt if isinstance(sample, ProbeSample) and sample.is_alive else None
+        self.late[ordinal] = (is_alive(sample), rtt)
+        if not self._open and len(self.late) >= LATE_RESULTS:
+            self._fold()
+
+    def seal(self):
+        """ Move the results into the columns once the cycle stops receiving them """
+        if self._open:
+            self._open = False
+            self._fold()
+
+    def _fold(self):
+        """ Merge the buffered results into the columns, a buffered result replacing an older one """
+        if not self.late:
+            return
+        count = len(self.late)
+        ordinals = np.concatenate((np.fromiter(self.late, dtype=np.uint32, count=count), self.ordinals))
+        alive = np.concatenate((np.fromiter((state for state, _ in self.late.values()), dtype=bool, count=count),
+                                self.alive))
+        rtt = np.concatenate((np.fromiter((np.nan if value is None else value for _, value in self.late.values()),
+                                          dtype=np.float32, count=count), self.rtt))
+        # np.unique keeps the first occurrence of each ordinal, the buffered ones come first.
+        self.ordinals, first = np.unique(ordinals, return_index=True)
+        self.alive, self.rtt = alive[first], rtt[first]
+        self.late = dict()
+
+    def columns(self, size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (probed, alive, rtt) spread over SIZE host ordinals """
+        probed, alive = np.zeros(size, dtype=bool), np.zeros(size, dtype=bool)
+        rtt = np.full(size, np.nan, dtype=np.float32)
+        probed[self.ordinals] = True
+        alive[self.ordinals] = self.alive
+        rtt[self.ordinals] = self.rtt
+        for ordinal, (state, value) in self.late.items():
+            probed[ordinal] = True
+            alive[ordinal] = state
+            rtt[ordinal] = np.nan if value is None else value
+        return probed, alive, rtt
+
+    def state(self, ordinal: int) -> Optional[bool]:
+        """ is_alive of the host with ORDINAL, None when it was not probed in this cycle """
+        if ordinal in self.late:
+            return self.late[ordinal][0]
+        index = int(np.searchsorted(self.ordinals, ordinal))
+        if index < len(self.ordinals) and self.ordinals[index] == ordinal:
+            return bool(self.alive[index])
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        return self.ordinals.nbytes + self.alive.nbytes + self.rtt.nbytes + len(self.late) * 16
+
+
+class ColumnarStorage(DefaultTreeStorage, IHaveMetrics, IHaveVersion, IHaveSize):
+    """ Every (service, date) cycle holds the hosts it probed by stable host ordinals, spread into full-width
+    columns only while a query reads them.
+
+    Services that share a name send their batches interleaved, so a cycle is sealed once a result
+    SEAL_AFTER seconds newer than it has arrived for its service, not when the next cycle starts """
+
+    def __init__(self, **kwargs):
+        self._seal_after: float = kwargs.get('seal_after', 60.0)
+        self._ordinals: Dict[str, int] = dict()
+        self._addresses: List[Optional[str]] = list()
+        self._cycles: Dict[str, Dict[int, Cycle]] = dict()
+        self._unsealed: Dict[str, List[Cycle]] = dict()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _ordinal(self, address: str) -> int:
+        ordinal = self._ordinals.get(address)
+        if ordinal is None:
+            ordinal = self._ordinals[address] = len(self._addresses)
+            self._addresses.append(address)
+        return ordinal
+
+    def add_key(self, name_key):
+        self._cycles.setdefault(name_key, dict())
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        self._version += 1
+        newest: Dict[str, int] = dict()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = parse_timestamp(date)
+            cycles = self._cycles.setdefault(service, dict())
+            cycle = cycles.get(timestamp)
+            if cycle is None:
+                cycle = cycles[timestamp] = Cycle(timestamp)
+                self._unsealed.setdefault(service, list()).append(cycle)
+            cycle.set(self._ordinal(address), sample)
+            if timestamp > newest.get(service, timestamp - 1):
+                newest[service] = timestamp
+        for service, timestamp in newest.items():
+            self._seal(service, timestamp - self._seal_after)
+
+    def _seal(self, service: str, before: float):
+        """ Seal the open cycles of SERVICE that are not newer than BEFORE """
+        unsealed = list()
+        for cycle in self._unsealed.get(service, ()):
+            if cycle.timestamp <= before:
+                cycle.seal()
+            else:
+                unsealed.append(cycle)
+        self._unsealed[service] = unsealed
+
+    def remove_data(self, key):
+        self._version += 1
+        if key in self._cycles:
+            del self._cycles[key]
+            self._unsealed.pop(key, None)
+        elif key in self._ordinals:
+            # The ordinal stays reserved so existing columns keep their meaning.
+            self._addresses[self._ordinals.pop(key)] = None
+
+    def _select(self, service: str = None) -> List[Cycle]:
+        return [cycle for service_, cycles in self._cycles.items() if service is None or service_ == service
+                for cycle in cycles.values()]
+
+    def _matrix(self, service: str = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ (probed, alive, rtt) as cycles x hosts arrays, oldest cycle first """
+        cycles = sorted(self._select(service), key=lambda cycle: cycle.timestamp)
+        size = len(self._addresses)
+        if not cycles:
+            empty = np.zeros((0, size), dtype=bool)
+            return empty, empty, np.zeros((0, size), dtype=np.float32)
+        columns = [cycle.columns(size) for cycle in cycles]
+        return tuple(np.stack(column) for column in zip(*columns))
+
+    def uptime(self, service: str = None) -> Dict[str, float]:
+        """ Share of probes each host answered """
+        probed, alive, _ = self._matrix(service)
+        probes = probed.sum(axis=0)
+        answered = (probed & alive).sum(axis=0)
+        return {address: float(answered[ordinal] / probes[ordinal])
+                for ordinal, address in enumerate(self._addresses) if address is not None and probes[ordinal]}
+
+    def current(self, service: str = None) -> np.ndarray:
+        """ Latest known state per ordinal: 1 up, 0 down, -1 never probed """
+        probed, alive, _ = self._matrix(service)
+        state = np.full(len(self._addresses), -1, dtype=np.int8)
+        if len(probed):
+            last = np.where(probed.any(axis=0), len(probed) - 1 - np.argmax(probed[::-1], axis=0), -1)
+            known = last >= 0
+            state[known] = alive[last[known], np.nonzero(known)[0]]
+        return state
+
+    def hosts_down(self, service: str = None) -> List[str]:
+        return [self._addresses[ordinal] for ordinal in np.nonzero(self.current(service) == 0)[0]
+                if self._addresses[ordinal] is not None]
+
+    def diff(self, before: int, after: int, service: str = None) -> Optional[Dict[str, List[str]]]:
+        """ Hosts that went down and came up between two cycles, None when either cycle is unknown """
+        before, after = parse_timestamp(before), parse_timestamp(after)
+        cycles = self._select(service)
+        first = next((cycle for cycle in cycles if cycle.timestamp == before), None)
+        second = next((cycle for cycle in cycles if cycle.timestamp == after), None)
+        if first is None or second is None:
+            return None
+        size = len(self._addresses)
+        first, second = first.columns(size), second.columns(size)
+        both = first[0] & second[0]
+        return {'down': self._names(both & first[1] & ~second[1]), 'up': self._names(both & ~first[1] & second[1])}
+
+    def _names(self, mask: np.ndarray) -> List[str]:
+        return [self._addresses[ordinal] for ordinal in np.nonzero(mask)[0] if self._addresses[ordinal] is not None]
+
+    def _hosts(self, cycle: Cycle) -> Dict[str, bool]:
+        probed, alive, _ = cycle.columns(len(self._addresses))
+        return {self._addresses[ordinal]: bool(alive[ordinal]) for ordinal in np.nonzero(probed)[0]
+                if self._addresses[ordinal] is not None}
+
+    def _lookup_tree(self) -> dict:
+        return {service: {date: self._hosts(cycle) for date, cycle in cycles.items()}
+                for service, cycles in self._cycles.items()}
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        if service not in self._cycles:
+            return None
+        return {date: self._hosts(cycle) for date, cycle in self._cycles[service].items()}
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        if address not in self._ordinals:
+            return None
+        ordinal = self._ordinals[address]
+        result = dict()
+        for cycle in self._select():
+            probed, alive, _ = cycle.columns(len(self._addresses))
+            if probed[ordinal]:
+                result[cycle.timestamp] = bool(alive[ordinal])
+        return result
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        for cycles in self._cycles.values():
+            if timestamp in cycles:
+                return self._hosts(cycles[timestamp])
+        return None
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._cycles
+
+    def _has_host(self, address: str) -> bool:
+        return address in self._ordinals
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        cycle = self._cycles.get(service, dict()).get(timestamp)
+        return None if cycle is None else self._hosts(cycle)
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        cycle = self._cycles.get(service, dict()).get(timestamp)
+        return None if cycle is None or address not in self._ordinals else cycle.state(self._ordinals[address])
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        # The last service wins, as it does in _lookup_host.
+        states = [self._lookup_sample(service, timestamp, address) for service in self._cycles]
+        return next((state for state in reversed(states) if state is not None), None)
+
+    def get_metrics(self, address: str = None) -> dict:
+        probed, _, rtt = self._matrix()
+        timestamps = sorted(cycle.timestamp for cycle in self._select())
+        ordinals = [self._ordinals[address]] if address in self._ordinals else \
+            [] if address is not None else range(len(self._addresses))
+        result = dict()
+        for ordinal in ordinals:
+            if self._addresses[ordinal] is None:
+                continue
+            rows = np.nonzero(probed[:, ordinal])[0]
+            result[self._addresses[ordinal]] = [{'time': timestamps[row], 'avg_rtt': float(rtt[row, ordinal])}
+                                                for row in rows if not np.isnan(rtt[row, ordinal])]
+        return result
+
+    @property
+    def nbytes(self) -> int:
+        return sum(cycle.nbytes for cycle in self._select())
@@ -0,0 +1,136 @@
+import asyncio
+from time import monotonic
+from typing import List, Union, Optional, Tuple
+
+from loguru import logger
+
+from observer import IObserver
+from result import IResult
+from storage.storage import IStorageFacade, IHaveStorageFacade, write
+
+
+def merge_results(values: List[dict]) -> dict:
+    """ One {service: {timestamp: {address: sample}}} tree out of many, later results win """
+    if len(values) == 1:
+        return values[0]
+    batch = dict()
+    for value in values:
+        for service, dates in value.items():
+            if not isinstance(dates, dict):
+                batch[service] = dates
+                continue
+            service_dates = batch.setdefault(service, dict())
+            for date, hosts in dates.items():
+                if isinstance(hosts, dict):
+                    service_dates.setdefault(date, dict()).update(hosts)
+                else:
+                    service_dates[date] = hosts
+    return batch
+
+
+class IngestQueue(IObserver, IHaveStorageFacade):
+    """ Bounded queue between notify() and storage: a single writer task coalesces results into one
+    add_data per BATCH_SIZE results or FLUSH_INTERVAL seconds. When the queue is full the notifying
+    service writes the backlog itself, which is the backpressure """
+
+    def __init__(self, **kwargs):
+        self._maxsize: int = kwargs.get('maxsize', 10000)
+        self._batch_size: int = kwargs.get('batch_size', 1000)
+        self._flush_interval: float = kwargs.get('flush_interval', 0.5)
+        self._storage_facade: Optional[IStorageFacade] = kwargs.get('storage_facade')
+        self._queue: Optional[asyncio.Queue] = None
+        self._full: Optional[asyncio.Event] = None
+        self._queued: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._received = 0
+        self._written = 0
+        self._batches = 0
+        self._overflows = 0
+        self._max_depth = 0
+        self._max_lag = 0.0
+        self._last_flush = 0.0
+
+    def set_storage_facade(self, storage_facade: IStorageFacade):
+        self._storage_facade = storage_facade
+        return self
+
+    def get_storage_facade(self) -> IStorageFacade:
+        return self._storage_facade
+
+    def _start(self) -> bool:
+        """ The writer needs a running loop; without one results are written inline """
+        if self._writer is not None:
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        self._queue = asyncio.Queue(self._maxsize)
+        self._full = asyncio.Event()
+        self._queued = asyncio.Event()
+        self._writer = loop.create_task(self._write())
+        return True
+
+    def update(self, result: Union[IResult, List[IResult]]) -> None:
+        results = result if isinstance(result, list) else [result]
+        values = [result_.get() for result_ in results if isinstance(result_, IResult)]
+        self._received += len(values)
+        if not self._start():
+            self._flush([(monotonic(), value) for value in values])
+            return
+        for value in values:
+            if self._queue.full():
+                self._overflows += 1
+                self.flush()
+            self._queue.put_nowait((monotonic(), value))
+        self._queued.set()
+        depth = self._queue.qsize()
+        self._max_depth = max(self._max_depth, depth)
+        if depth >= self._batch_size:
+            self._full.set()
+
+    def _drain(self, limit: int = None) -> List[Tuple[float, dict]]:
+        items = list()
+        while not self._queue.empty() and (limit is None or len(items) < limit):
+            items.append(self._queue.get_nowait())
+        return items
+
+    def _flush(self, items: List[Tuple[float, dict]]):
+        if not items:
+            return
+        started = monotonic()
+        self._max_lag = max(self._max_lag, started - items[0][0])
+        try:
+            write(self._storage_facade.storage, merge_results([value for _, value in items]))
+        except Exception as exception:
+            logger.exception(f'Ошибка записи пакета из {len(items)} результатов: {exception}')
+        self._written += len(items)
+        self._batches += 1
+        self._last_flush = monotonic() - started
+
+    def flush(self):
+        """ Write everything queued so far, synchronously """
+        while self._queue is not None and not self._queue.empty():
+            self._flush(self._drain(self._batch_size))
+
+    async def _write(self):
+        # Results stay queued until they are written: an overflow flush() in the meantime writes them
+        # before anything newer, so later results still win.
+        while True:
+            await self._queued.wait()
+            if self._queue.qsize() < self._batch_size:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self._flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush(self._drain(self._batch_size))
+            if self._queue.empty():
+                self._queued.clear()
+
+    def stats(self) -> dict:
+        return {'depth': self._queue.qsize() if self._queue is not None else 0, 'max_depth': self._max_depth,
+                'maxsize': self._maxsize, 'received': self._received, 'written': self._written,
+                'batches': self._batches, 'avg_batch': round(self._written / self._batches, 1) if self._batches else 0,
+                'overflows': self._overflows, 'max_lag': round(self._max_lag, 3),
+                'last_flush_ms': round(self._last_flush * 1000, 3)}
@@ -1,4 +1,4 @@
-from observer import DefaultObserver
+from storage.ingest import IngestQueue
 from storage.storage import IStorageFacade, StorageFacade, RAMMemoryStorage
 
-storage: IStorageFacade = StorageFacade(storage=RAMMemoryStorage(), observer=DefaultObserver())
+storage: IStorageFacade = StorageFacade(storage=RAMMemoryStorage(), observer=IngestQueue())
@@ -0,0 +1,446 @@
+import asyncio
+import math
+import mmap
+import os
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Dict, List, Optional, Iterator, Tuple, Set
+
+from loguru import logger
+
+from sample import ProbeSample, iter_samples, parse_timestamp, is_alive
+from storage.storage import DefaultTreeStorage, IHaveMetrics, ICompactableStorage, IHaveAsyncCompaction, \
+    IHaveVersion, IHaveRecords, IHaveSize
+
+# host ordinal, epoch seconds, service ordinal, is_alive, avg RTT (NaN when unknown)
+RECORD = struct.Struct('<IIHBf')
+_INDEX_HEADER = struct.Struct('<qqI')
+_COUNT = struct.Struct('<I')
+
+_Record = Tuple[int, int, int, int, float]
+
+
+class Segment:
+    """ One append-only file of RECORD entries and its index: host ordinal -> record numbers, plus the
+    service ordinals it holds """
+    __slots__ = 'path', 'index_path', 'number', 'first', 'last', 'hosts', 'services', 'checked', '_map', '_mapped'
+
+    def __init__(self, directory: str, number: int, suffix: str = ''):
+        self.number = number
+        self.path = os.path.join(directory, f'{number:08d}.log{suffix}')
+        self.index_path = os.path.join(directory, f'{number:08d}.idx{suffix}')
+        self.first = self.last = None
+        self.hosts: Dict[int, array] = dict()
+        self.services: Set[int] = set()
+        # Tombstone count of the storage when the segment was last found to hold no removed names.
+        self.checked = -1
+        self._map: Optional[mmap.mmap] = None
+        self._mapped = 0
+
+    def __len__(self):
+        return os.path.getsize(self.path) // RECORD.size
+
+    def index(self, number: int, host: int, timestamp: int, service: int):
+        positions = self.hosts.get(host)
+        if positions is None:
+            positions = self.hosts[host] = array('I')
+        positions.append(number)
+        self.services.add(service)
+        self.first = timestamp if self.first is None else min(self.first, timestamp)
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+
+    def rebuild(self):
+        self.first = self.last = None
+        self.hosts.clear()
+        self.services.clear()
+        for number, (host, timestamp, service, *_) in enumerate(self.records()):
+            self.index(number, host, timestamp, service)
+
+    def save_index(self):
+        hosts = array('I', self.hosts)
+        counts = array('I', (len(positions) for positions in self.hosts.values()))
+        services = array('I', self.services)
+        with open(self.index_path, 'wb') as file:
+            file.write(_INDEX_HEADER.pack(self.first or 0, self.last or 0, len(hosts)))
+            hosts.tofile(file)
+            counts.tofile(file)
+            for positions in self.hosts.values():
+                positions.tofile(file)
+            file.write(_COUNT.pack(len(services)))
+            services.tofile(file)
+
+    def load_index(self) -> bool:
+        """ False when the index is missing, torn or was written without the service ordinals """
+        try:
+            with open(self.index_path, 'rb') as file:
+                self.first, self.last, size = _INDEX_HEADER.unpack(file.read(_INDEX_HEADER.size))
+                hosts, counts = array('I'), array('I')
+                hosts.fromfile(file, size)
+                counts.fromfile(file, size)
+                for host, count in zip(hosts, counts):
+                    positions = self.hosts[host] = array('I')
+                    positions.fromfile(file, count)
+                services = array('I')
+                services.fromfile(file, _COUNT.unpack(file.read(_COUNT.size))[0])
+                self.services.update(services)
+        except (OSError, EOFError, struct.error):
+            self.hosts.clear()
+            self.services.clear()
+            return False
+        return True
+
+    def view(self) -> Optional[mmap.mmap]:
+        """ Read-only map of the file, remapped when the file has grown since the last call. Iterators keep
+        the map they started on, so an export goes on reading it after a remap or a compaction """
+        size = len(self) * RECORD.size
+        if size != self._mapped:
+            self.close()
+            if size:
+                with open(self.path, 'rb') as file:
+                    self._map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped = size
+        return self._map
+
+    def records(self, host: int = None) -> Iterator[_Record]:
+        view = self.view()
+        if view is None:
+            return
+        if host is None:
+            yield from RECORD.iter_unpack(view)
+        else:
+            count = len(view) // RECORD.size
+            for number in self.hosts.get(host, ()):
+                # Positions appended after the map was taken are past its end.
+                if number >= count:
+                    break
+                yield RECORD.unpack_from(view, number * RECORD.size)
+
+    def close(self):
+        """ Drop the map rather than close it: a live iterator may still read it, and closing a map with
+        exported buffers fails; it is unmapped when the last reader lets go """
+        self._map, self._mapped = None, 0
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class ProbeLogStorage(DefaultTreeStorage, IHaveMetrics, IHaveRecords, ICompactableStorage, IHaveAsyncCompaction,
+                      IHaveVersion, IHaveSize):
+    """ Append-only log of fixed-size records in DIRECTORY, rotated every SEGMENT_SIZE bytes.
+
+    Sealed segments keep their index on disk, so startup only rescans the last segment. Host and
+    service names live in an append-only names file and are referred to by ordinal """
+
+    def __init__(self, **kwargs):
+        self._directory: str = kwargs.get('directory', 'probe_log')
+        self._segment_size: int = kwargs.get('segment_size', 8 * 1024 * 1024)
+        self._retention: Optional[float] = kwargs.get('retention')
+        os.makedirs(self._directory, exist_ok=True)
+        self._ordinals: Dict[str, Dict[str, int]] = {'h': dict(), 's': dict()}
+        self._names: Dict[str, List[Optional[str]]] = {'h': list(), 's': list()}
+        # Names removed so far: a segment checked at this count holds no removed names.
+        self._tombstones = 0
+        self._load_names()
+        self._names_file = open(os.path.join(self._directory, 'names'), 'a', encoding='utf-8')
+        self._segments: List[Segment] = list()
+        self._load_segments()
+        self._active = open(self._segments[-1].path, 'ab')
+        self._version = 0
+        self._compacting = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='probe-log')
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def nbytes(self) -> int:
+        return sum(os.path.getsize(segment.path) for segment in self._segments if os.path.exists(segment.path))
+
+    def _load_names(self):
+        path = os.path.join(self._directory, 'names')
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    break  # torn last line, the records that would use it were never written
+                kind, value = line[:-1].split('\t', 1)
+                if kind in self._names:
+                    self._ordinals[kind][value] = len(self._names[kind])
+                    self._names[kind].append(value)
+                else:
+                    ordinal = int(value)
+                    kind = kind[1:]
+                    name = self._names[kind][ordinal]
+                    if self._ordinals[kind].get(name) == ordinal:
+                        del self._ordinals[kind][name]
+                    self._names[kind][ordinal] = None
+                    self._tombstones += 1
+
+    def _load_segments(self):
+        numbers = sorted(int(name[:-len('.log')]) for name in os.listdir(self._directory) if name.endswith('.log'))
+        for number in numbers[:-1]:
+            segment = Segment(self._directory, number)
+            if not segment.load_index():
+                segment.rebuild()
+                segment.save_index()
+            self._segments.append(segment)
+        active = Segment(self._directory, numbers[-1] if numbers else 1)
+        if os.path.exists(active.path):
+            # A crash can leave half a record at the end of the active segment.
+            with open(active.path, 'r+b') as file:
+                file.truncate(len(active) * RECORD.size)
+            active.rebuild()
+        else:
+            open(active.path, 'wb').close()
+        self._segments.append(active)
+        logger.info(f'Журнал опроса {self._directory}: сегментов {len(self._segments)}, '
+                    f'записей в последнем {len(active)}')
+
+    def _ordinal(self, kind: str, name: str) -> int:
+        ordinal = self._ordinals[kind].get(name)
+        if ordinal is None:
+            ordinal = self._ordinals[kind][name] = len(self._names[kind])
+            self._names[kind].append(name)
+            # Names reach the disk before any record that refers to them.
+            self._names_file.write(f'{kind}\t{name}\n')
+            self._names_file.flush()
+        return ordinal
+
+    def add_key(self, name_key):
+        self._ordinal('s', name_key)
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        segment = self._segments[-1]
+        number = len(segment)
+        timestamps: Dict[str, int] = dict()
+        buffer = bytearray()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = timestamps.get(date)
+            if timestamp is None:
+                timestamp = timestamps[date] = parse_timestamp(date)
+            host, service = self._ordinal('h', address), self._ordinal('s', service)
+            rtt = sample.avg_rtt if isinstance(sample, ProbeSample) and sample.is_alive else math.nan
+            buffer += RECORD.pack(host, timestamp, service, is_alive(sample), rtt)
+            segment.index(number, host, timestamp, service)
+            number += 1
+        if buffer:
+            self._version += 1
+            self._active.write(buffer)
+            self._active.flush()
+            if number * RECORD.size >= self._segment_size:
+                self._rotate()
+
+    def _rotate(self):
+        sealed = self._segments[-1]
+        os.fsync(self._active.fileno())
+        self._active.close()
+        sealed.save_index()
+        segment = Segment(self._directory, sealed.number + 1)
+        self._active = open(segment.path, 'ab')
+        self._segments.append(segment)
+        self._drop_expired()
+
+    def _drop_expired(self):
+        if self._retention is None:
+            return
+        oldest = time() - self._retention
+        for segment in [segment for segment in self._segments[:-1] if segment.last is not None and
+                        segment.last < oldest]:
+            segment.remove()
+            self._segments.remove(segment)
+
+    def _stale(self, oldest: Optional[float]) -> List[Segment]:
+        """ Sealed segments that hold records of removed hosts or services, or that are at least half
+        past the retention; the rest would be rewritten unchanged """
+        hosts, services = self._names['h'], self._names['s']
+        stale = list()
+        for segment in self._segments[:-1]:
+            if segment.first is None:
+                continue
+            if oldest is not None and oldest - segment.first >= (segment.last - segment.first) / 2:
+                stale.append(segment)
+            elif segment.checked != self._tombstones:
+                if any(hosts[host] is None for host in segment.hosts) or \
+                        any(services[service] is None for service in segment.services):
+                    stale.append(segment)
+                else:
+                    segment.checked = self._tombstones
+        return stale
+
+    def _rewrite(self, segment: Segment, oldest: Optional[float]) -> Segment:
+        """ Live records of SEGMENT copied to .tmp files next to it, index included. The file is read
+        through a handle of its own, so this may run in the executor while the storage is in use """
+        hosts, services = self._names['h'], self._names['s']
+        rewritten = Segment(self._directory, segment.number, '.tmp')
+        with open(segment.path, 'rb') as file:
+            data = file.read()
+        buffer = bytearray()
+        number = 0
+        for offset, (host, timestamp, service, *_) in zip(range(0, len(data), RECORD.size), RECORD.iter_unpack(data)):
+            if hosts[host] is None or services[service] is None or (oldest is not None and timestamp < oldest):
+                continue
+            buffer += data[offset:offset + RECORD.size]
+            rewritten.index(number, host, timestamp, service)
+            number += 1
+        with open(rewritten.path, 'wb') as file:
+            file.write(buffer)
+            os.fsync(file.fileno())
+        rewritten.save_index()
+        return rewritten
+
+    def _install(self, segment: Segment, rewritten: Segment, tombstones: int):
+        """ Swap the rewritten files in for SEGMENT, unless it was dropped in the meantime """
+        if segment not in self._segments:
+            rewritten.remove()
+            return
+        self._version += 1
+        segment.close()
+        if len(rewritten) == 0:
+            rewritten.remove()
+            segment.remove()
+            self._segments.remove(segment)
+            return
+        os.replace(rewritten.path, segment.path)
+        os.replace(rewritten.index_path, segment.index_path)
+        segment.first, segment.last = rewritten.first, rewritten.last
+        segment.hosts, segment.services = rewritten.hosts, rewritten.services
+        segment.checked = tombstones
+
+    def compact(self):
+        """ Rewrite the sealed segments that hold removed hosts or services or mostly expired records """
+        self._drop_expired()
+        oldest = time() - self._retention if self._retention is not None else None
+        tombstones = self._tombstones
+        for segment in self._stale(oldest):
+            self._install(segment, self._rewrite(segment, oldest), tombstones)
+
+    async def compact_async(self):
+        """ compact() with the segment rewrites on the storage's own thread; only the file swaps run on the loop """
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            self._drop_expired()
+            oldest = time() - self._retention if self._retention is not None else None
+            tombstones = self._tombstones
+            loop = asyncio.get_running_loop()
+            for segment in self._stale(oldest):
+                rewritten = await loop.run_in_executor(self._executor, self._rewrite, segment, oldest)
+                self._install(segment, rewritten, tombstones)
+        finally:
+            self._compacting = False
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._active.close()
+        self._names_file.close()
+        for segment in self._segments:
+            segment.close()
+
+    def remove_data(self, key):
+        self._version += 1
+        for kind in ('s', 'h'):
+            ordinal = self._ordinals[kind].pop(key, None)
+            if ordinal is not None:
+                self._names[kind][ordinal] = None
+                self._tombstones += 1
+                self._names_file.write(f'-{kind}\t{ordinal}\n')
+                self._names_file.flush()
+                return
+
+    def _live(self, record: _Record) -> bool:
+        return self._names['h'][record[0]] is not None and self._names['s'][record[2]] is not None
+
+    def _records(self, host: str = None, timestamp: int = None, service: str = None) -> Iterator[_Record]:
+        if host is not None and host not in self._ordinals['h'] or \
+                service is not None and service not in self._ordinals['s']:
+            return
+        ordinal = self._ordinals['h'][host] if host is not None else None
+        service_ordinal = self._ordinals['s'][service] if service is not None else None
+        oldest = time() - self._retention if self._retention is not None else None
+        for segment in self._segments:
+            if timestamp is not None and (segment.first is None or not segment.first <= timestamp <= segment.last):
+                continue
+            if service is not None and service_ordinal not in segment.services:
+                continue
+            for record in segment.records(ordinal):
+                if timestamp is not None and record[1] != timestamp or \
+                        service is not None and record[2] != service_ordinal:
+                    continue
+                if (oldest is None or record[1] >= oldest) and self._live(record):
+                    yield record
+
+    def _tree(self, records: Iterator[_Record]) -> dict:
+        services, hosts = self._names['s'], self._names['h']
+        tree = {service: dict() for service in services if service is not None}
+        for host, timestamp, service, state, _ in records:
+            tree[services[service]].setdefault(timestamp, dict())[hosts[host]] = bool(state)
+        return tree
+
+    def _lookup_tree(self) -> dict:
+        return self._tree(self._records())
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        return self._tree(self._records(service=service))[service] if service in self._ordinals['s'] else None
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        if address not in self._ordinals['h']:
+            return None
+        return {timestamp: bool(state) for _, timestamp, _, state, _ in self._records(address)}
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        for dates in self._tree(self._records(timestamp=timestamp)).values():
+            if dates:
+                return next(iter(dates.values()))
+        return None
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._ordinals['s']
+
+    def _has_host(self, address: str) -> bool:
+        return address in self._ordinals['h']
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        hosts = self._names['h']
+        records = self._records(timestamp=timestamp, service=service)
+        cycle = {hosts[host]: bool(state) for host, _, _, state, _ in records}
+        return cycle or None
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        states = [state for _, _, _, state, _ in self._records(address, timestamp, service)]
+        return bool(states[-1]) if states else None
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        states = [state for _, _, _, state, _ in self._records(address, timestamp)]
+        return bool(states[-1]) if states else None
+
+    def records(self, start: int = None, end: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+        """ Records in log order, read from the mapped segments; segments outside the range are skipped """
+        services, hosts = self._names['s'], self._names['h']
+        oldest = time() - self._retention if self._retention is not None else None
+        for segment in list(self._segments):
+            if segment.first is None or (start is not None and segment.last < start) or \
+                    (end is not None and segment.first > end):
+                continue
+            for record in segment.records():
+                host, timestamp, service, state, _ = record
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end) and \
+                        (oldest is None or timestamp >= oldest) and self._live(record):
+                    yield services[service], timestamp, hosts[host], bool(state)
+
+    def get_metrics(self, address: str = None) -> dict:
+        hosts = self._names['h']
+        result = dict()
+        for host, timestamp, _, _, rtt in self._records(address):
+            if not math.isnan(rtt):
+                result.setdefault(hosts[host], list()).append({'time': timestamp, 'avg_rtt': rtt})
+        return result
@@ -0,0 +1,179 @@
+from array import array
+from time import time
+from typing import Dict, Iterator, Tuple, Union, Optional
+
+from sample import METRICS, ProbeSample, iter_samples, parse_timestamp, is_alive
+from storage.storage import DefaultTreeStorage, IHaveMetrics, IHaveVersion, IHaveSize
+
+_NO_METRICS = (0.0,) * len(METRICS)
+
+
+class HostRing:
+    """ Fixed-capacity ring of (timestamp, state, metrics) records, O(1) append.
+
+    DISORDER counts the appends left until no record older than its predecessor remains: at 0 the
+    timestamps ascend and find() bisects them """
+    __slots__ = 'capacity', 'head', 'size', 'timestamps', 'states', 'metrics', 'disorder'
+
+    RECORD_SIZE = array('l').itemsize + 1 + len(METRICS) * array('f').itemsize
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.head = 0
+        self.size = 0
+        self.timestamps = array('l', bytes(capacity * array('l').itemsize))
+        self.states = bytearray(capacity)
+        self.metrics = array('f', bytes(capacity * len(METRICS) * array('f').itemsize))
+        self.disorder = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp: int, sample: Union[ProbeSample, bool]):
+        index = self.head
+        if self.size and timestamp < self.timestamps[index - 1]:
+            self.disorder = self.capacity
+        elif self.disorder:
+            self.disorder -= 1
+        self.timestamps[index] = timestamp
+        self.states[index] = is_alive(sample)
+        base = index * len(METRICS)
+        for offset, value in enumerate(sample.metrics if isinstance(sample, ProbeSample) else _NO_METRICS):
+            self.metrics[base + offset] = value
+        self.head = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def find(self, timestamp: int) -> Optional[bool]:
+        """ State recorded at TIMESTAMP, the newest one when there are several """
+        start = (self.head - self.size) % self.capacity
+        if self.disorder:
+            for offset in range(self.size - 1, -1, -1):
+                index = (start + offset) % self.capacity
+                if self.timestamps[index] == timestamp:
+                    return bool(self.states[index])
+            return None
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[(start + middle) % self.capacity] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        index = (start + low - 1) % self.capacity
+        return bool(self.states[index]) if low and self.timestamps[index] == timestamp else None
+
+    def __iter__(self) -> Iterator[Tuple[int, bool, Tuple[float, ...]]]:
+        """ Oldest record first """
+        width = len(METRICS)
+        start = (self.head - self.size) % self.capacity
+        for offset in range(self.size):
+            index = (start + offset) % self.capacity
+            yield self.timestamps[index], bool(self.states[index]), \
+                tuple(self.metrics[index * width:(index + 1) * width])
+
+
+class RingBufferStorage(DefaultTreeStorage, IHaveMetrics, IHaveVersion, IHaveSize):
+    """ One HostRing per (service, address): memory is hosts x capacity x HostRing.RECORD_SIZE """
+
+    def __init__(self, **kwargs):
+        self._capacity: int = kwargs.get('capacity', 1440)
+        self._retention: float = kwargs.get('retention')
+        self._rings: Dict[str, Dict[str, HostRing]] = dict()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(rings) for rings in self._rings.values()) * self._capacity * HostRing.RECORD_SIZE
+
+    def add_key(self, name_key):
+        self._rings.setdefault(name_key, dict())
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        self._version += 1
+        for service, date, address, sample in iter_samples(value):
+            rings = self._rings.setdefault(service, dict())
+            ring = rings.get(address)
+            if ring is None:
+                ring = rings[address] = HostRing(self._capacity)
+            ring.append(parse_timestamp(date), sample)
+
+    def remove_data(self, key):
+        self._version += 1
+        if key in self._rings:
+            del self._rings[key]
+            return
+        for rings in self._rings.values():
+            rings.pop(key, None)
+
+    def _records(self, service: str = None, address: str = None) -> Iterator[Tuple[str, str, int, bool, tuple]]:
+        oldest = time() - self._retention if self._retention is not None else None
+        for service_, rings in self._rings.items():
+            if service is not None and service_ != service:
+                continue
+            for address_, ring in rings.items():
+                if address is not None and address_ != address:
+                    continue
+                for timestamp, state, metrics in ring:
+                    if oldest is None or timestamp >= oldest:
+                        yield service_, address_, timestamp, state, metrics
+
+    def _lookup_tree(self) -> dict:
+        return self._tree()
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        return self._tree(service=service)[service] if service in self._rings else None
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        if not any(address in rings for rings in self._rings.values()):
+            return None
+        return {timestamp: state for _, _, timestamp, state, _ in self._records(address=address)}
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        for service in self._rings:
+            hosts = self._lookup_cycle(service, timestamp)
+            if hosts is not None:
+                return hosts
+        return None
+
+    def _expired(self, timestamp: int) -> bool:
+        return self._retention is not None and timestamp < time() - self._retention
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._rings
+
+    def _has_host(self, address: str) -> bool:
+        return any(address in rings for rings in self._rings.values())
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        if self._expired(timestamp):
+            return None
+        hosts = {address: state for address, ring in self._rings.get(service, dict()).items()
+                 for state in (ring.find(timestamp),) if state is not None}
+        return hosts or None
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        ring = self._rings.get(service, dict()).get(address)
+        return None if ring is None or self._expired(timestamp) else ring.find(timestamp)
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        # The last service wins, as it does in the merged history of _lookup_host.
+        states = [self._lookup_sample(service, timestamp, address) for service in self._rings]
+        return next((state for state in reversed(states) if state is not None), None)
+
+    def _tree(self, service: str = None) -> dict:
+        tree = {service_: dict() for service_ in self._rings if service is None or service_ == service}
+        for service_, address, timestamp, state, _ in self._records(service=service):
+            tree[service_].setdefault(timestamp, dict())[address] = state
+        return tree
+
+    def get_metrics(self, address: str = None) -> dict:
+        result = dict()
+        for _, address_, timestamp, _, metrics in self._records(address=address):
+            result.setdefault(address_, list()).append(dict(time=timestamp, **dict(zip(METRICS, metrics))))
+        return result
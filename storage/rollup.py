@@ -0,0 +1,291 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from time import time
+from typing import Dict, List, Optional, Tuple, Iterator, Sequence
+
+from sample import ProbeSample, iter_samples, parse_timestamp, is_alive
+from storage.storage import DefaultTreeStorage, IHaveMetrics, IHaveAvailability, ICompactableStorage, IHaveVersion
+
+MINUTE, HOUR, DAY = 60, 60 * 60, 24 * 60 * 60
+
+# (resolution, retention) in seconds, finest first
+DEFAULT_TIERS = ((MINUTE, DAY), (HOUR, 30 * DAY), (DAY, 365 * DAY))
+
+
+class Bucket:
+    """ Probe counts and RTT extremes of one host over one tier interval """
+    __slots__ = 'up', 'down', 'rtt_min', 'rtt_max', 'rtt_sum', 'rtt_count'
+
+    def __init__(self):
+        self.up = self.down = self.rtt_count = 0
+        self.rtt_min = self.rtt_max = None
+        self.rtt_sum = 0.0
+
+    def add(self, alive: bool, rtt: Optional[float]):
+        if alive:
+            self.up += 1
+        else:
+            self.down += 1
+        if rtt is not None:
+            self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+            self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+            self.rtt_sum += rtt
+            self.rtt_count += 1
+
+    def merge(self, other: 'Bucket'):
+        self.up += other.up
+        self.down += other.down
+        if other.rtt_count:
+            self.rtt_min = other.rtt_min if self.rtt_min is None else min(self.rtt_min, other.rtt_min)
+            self.rtt_max = other.rtt_max if self.rtt_max is None else max(self.rtt_max, other.rtt_max)
+            self.rtt_sum += other.rtt_sum
+            self.rtt_count += other.rtt_count
+
+    def get(self) -> dict:
+        probes = self.up + self.down
+        return {'up': self.up, 'down': self.down, 'availability': self.up / probes if probes else None,
+                'min_rtt': self.rtt_min, 'avg_rtt': self.rtt_sum / self.rtt_count if self.rtt_count else None,
+                'max_rtt': self.rtt_max}
+
+
+class Tier:
+    """ Buckets of RESOLUTION seconds per host, dropped after RETENTION seconds """
+    __slots__ = 'resolution', 'retention', 'hosts'
+
+    def __init__(self, resolution: int, retention: float):
+        self.resolution = resolution
+        self.retention = retention
+        # Each host's dict is kept oldest first, so trim() and oldest() only look at its head.
+        self.hosts: Dict[str, Dict[int, Bucket]] = dict()
+
+    def add(self, address: str, timestamp: int, alive: bool, rtt: Optional[float]):
+        buckets = self.hosts.get(address)
+        if buckets is None:
+            buckets = self.hosts[address] = dict()
+        start = timestamp - timestamp % self.resolution
+        bucket = buckets.get(start)
+        if bucket is None:
+            late = buckets and next(reversed(buckets)) > start
+            bucket = buckets[start] = Bucket()
+            if late:
+                # A late sample opened a bucket older than the newest one, rare enough to re-sort for.
+                self.hosts[address] = dict(sorted(buckets.items()))
+        bucket.add(alive, rtt)
+
+    def trim(self, now: float):
+        oldest = now - self.retention
+        for address in list(self.hosts):
+            buckets = self.hosts[address]
+            while buckets and next(iter(buckets)) + self.resolution <= oldest:
+                del buckets[next(iter(buckets))]
+            if not buckets:
+                del self.hosts[address]
+
+    def oldest(self) -> Optional[int]:
+        return min((next(iter(buckets)) for buckets in self.hosts.values()), default=None)
+
+
+class RawSeries:
+    """ Raw samples of one (service, host), sorted by timestamp """
+    __slots__ = 'timestamps', 'states', 'rtt'
+
+    def __init__(self):
+        self.timestamps = array('l')
+        self.states = bytearray()
+        self.rtt = array('f')
+
+    def add(self, timestamp: int, alive: bool, rtt: Optional[float]):
+        index = len(self.timestamps)
+        if index and self.timestamps[-1] > timestamp:
+            index = bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(index, timestamp)
+        self.states.insert(index, alive)
+        self.rtt.insert(index, float('nan') if rtt is None else rtt)
+
+    def trim(self, oldest: float):
+        count = bisect_left(self.timestamps, oldest)
+        if count:
+            del self.timestamps[:count], self.states[:count], self.rtt[:count]
+
+    def at(self, timestamp: int) -> Optional[bool]:
+        """ State at TIMESTAMP, the last one added when there are several """
+        index = bisect_right(self.timestamps, timestamp) - 1
+        return bool(self.states[index]) if index >= 0 and self.timestamps[index] == timestamp else None
+
+    def range(self, start: float = None, end: float = None) -> Iterator[Tuple[int, bool, float]]:
+        first = 0 if start is None else bisect_left(self.timestamps, start)
+        last = len(self.timestamps) if end is None else bisect_left(self.timestamps, end)
+        for index in range(first, last):
+            yield self.timestamps[index], bool(self.states[index]), self.rtt[index]
+
+
+class RollupStorage(DefaultTreeStorage, IHaveMetrics, IHaveAvailability, ICompactableStorage, IHaveVersion):
+    """ Raw samples for RAW_RETENTION seconds plus per-host rollup TIERS.
+
+    Every sample is added to its bucket in each tier at once, compact() only drops what has outlived a
+    retention, so it stays cheap enough to run periodically from CompactionService. Range queries are
+    answered from the finest tier that still holds the start of the range """
+
+    def __init__(self, **kwargs):
+        self._raw_retention: float = kwargs.get('raw_retention', HOUR)
+        self._tiers = [Tier(resolution, retention) for resolution, retention in kwargs.get('tiers', DEFAULT_TIERS)]
+        self._raw: Dict[str, Dict[str, RawSeries]] = dict()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def add_key(self, name_key):
+        self._raw.setdefault(name_key, dict())
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        self._version += 1
+        timestamps: Dict[str, int] = dict()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = timestamps.get(date)
+            if timestamp is None:
+                timestamp = timestamps[date] = parse_timestamp(date)
+            alive = is_alive(sample)
+            rtt = sample.avg_rtt if isinstance(sample, ProbeSample) and alive else None
+            series = self._raw.setdefault(service, dict()).get(address)
+            if series is None:
+                series = self._raw[service][address] = RawSeries()
+            series.add(timestamp, alive, rtt)
+            for tier in self._tiers:
+                tier.add(address, timestamp, alive, rtt)
+
+    def remove_data(self, key):
+        self._version += 1
+        if key in self._raw:
+            del self._raw[key]
+            return
+        for series in self._raw.values():
+            series.pop(key, None)
+        for tier in self._tiers:
+            tier.hosts.pop(key, None)
+
+    def compact(self, now: float = None):
+        now = time() if now is None else now
+        self._version += 1
+        oldest = now - self._raw_retention
+        for hosts in self._raw.values():
+            for address in list(hosts):
+                hosts[address].trim(oldest)
+                if not hosts[address].timestamps:
+                    del hosts[address]
+        for tier in self._tiers:
+            tier.trim(now)
+
+    def _tier(self, start: float) -> Optional[Tier]:
+        """ The finest tier that still covers START, None when raw samples do """
+        oldest_raw = min((series.timestamps[0] for hosts in self._raw.values() for series in hosts.values()
+                          if series.timestamps), default=None)
+        if oldest_raw is not None and oldest_raw <= start:
+            return None
+        for tier in self._tiers:
+            oldest = tier.oldest()
+            if oldest is not None and oldest <= start:
+                return tier
+        return self._tiers[-1] if self._tiers else None
+
+    def rollup(self, address: str, start: float = None, end: float = None, resolution: int = None) -> List[dict]:
+        """ Buckets of one host between START and END, from the tier with RESOLUTION or the finest covering one;
+        ValueError when no tier has RESOLUTION """
+        start = 0 if start is None else start
+        if resolution is not None:
+            tier = next((tier for tier in self._tiers if tier.resolution == resolution), None)
+            if tier is None:
+                raise ValueError(f'Нет уровня с разрешением {resolution} с, есть: '
+                                 f'{", ".join(str(tier.resolution) for tier in self._tiers)}')
+        else:
+            tier = self._tier(start) or self._tiers[0]
+        return [dict(time=bucket_start, **bucket.get()) for bucket_start, bucket in
+                sorted(tier.hosts.get(address, dict()).items())
+                if bucket_start + tier.resolution > start and (end is None or bucket_start < end)]
+
+    def availability(self, start: float = None, end: float = None, address: str = None) -> Dict[str, dict]:
+        start = 0 if start is None else start
+        tier = self._tier(start)
+        result: Dict[str, Bucket] = dict()
+        if tier is None:
+            for hosts in self._raw.values():
+                for address_, series in hosts.items():
+                    if address is not None and address_ != address:
+                        continue
+                    bucket = result.setdefault(address_, Bucket())
+                    for _, alive, rtt in series.range(start, end):
+                        bucket.add(alive, None if rtt != rtt else rtt)
+        else:
+            hosts = {address: tier.hosts[address]} if address in tier.hosts else \
+                dict() if address is not None else tier.hosts
+            for address_, buckets in hosts.items():
+                bucket = result[address_] = Bucket()
+                for bucket_start, bucket_ in buckets.items():
+                    if bucket_start + tier.resolution > start and (end is None or bucket_start < end):
+                        bucket.merge(bucket_)
+        return {address_: bucket.get() for address_, bucket in result.items() if bucket.up + bucket.down}
+
+    def _records(self, service: str = None, address: str = None) -> Iterator[Tuple[str, str, int, bool, float]]:
+        for service_, hosts in self._raw.items():
+            if service is not None and service_ != service:
+                continue
+            for address_, series in hosts.items():
+                if address is None or address_ == address:
+                    for timestamp, alive, rtt in series.range():
+                        yield service_, address_, timestamp, alive, rtt
+
+    def _tree(self, records: Iterator[Tuple[str, str, int, bool, float]], services: Sequence[str]) -> dict:
+        tree = {service: dict() for service in services}
+        for service, address, timestamp, alive, _ in sorted(records, key=lambda record: record[2]):
+            tree[service].setdefault(timestamp, dict())[address] = alive
+        return tree
+
+    def _lookup_tree(self) -> dict:
+        """ Only the raw samples of the last RAW_RETENTION seconds, the tiers are not in the tree """
+        return self._tree(self._records(), tuple(self._raw))
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        return self._tree(self._records(service=service), (service,))[service] if service in self._raw else None
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        if not any(address in hosts for hosts in self._raw.values()):
+            return None
+        return {timestamp: alive for _, _, timestamp, alive, _ in
+                sorted(self._records(address=address), key=lambda record: record[2])}
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        for service in self._raw:
+            hosts = self._lookup_cycle(service, timestamp)
+            if hosts is not None:
+                return hosts
+        return None
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._raw
+
+    def _has_host(self, address: str) -> bool:
+        return any(address in hosts for hosts in self._raw.values())
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        hosts = {address: state for address, series in self._raw.get(service, dict()).items()
+                 for state in (series.at(timestamp),) if state is not None}
+        return hosts or None
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        series = self._raw.get(service, dict()).get(address)
+        return None if series is None else series.at(timestamp)
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        # The last service wins, as it does in the merged history of _lookup_host.
+        states = [self._lookup_sample(service, timestamp, address) for service in self._raw]
+        return next((state for state in reversed(states) if state is not None), None)
+
+    def get_metrics(self, address: str = None) -> dict:
+        result = dict()
+        for _, address_, timestamp, _, rtt in self._records(address=address):
+            if rtt == rtt:
+                result.setdefault(address_, list()).append({'time': timestamp, 'avg_rtt': rtt})
+        return result
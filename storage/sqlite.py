@@ -0,0 +1,245 @@
+import atexit
+import os
+import sqlite3
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Iterator
+
+from loguru import logger
+
+from sample import METRICS, ProbeSample, iter_samples, parse_timestamp
+from storage.storage import DefaultTreeStorage, IHaveMetrics, IBlockingStorage, IHaveVersion, IHaveRecords, \
+    IHaveSize, IHaveRows
+
+_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS samples (
+    host TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    service TEXT NOT NULL,
+    alive INTEGER NOT NULL,
+    {', '.join(f'{metric} REAL' for metric in METRICS)},
+    PRIMARY KEY (host, ts, service)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samples_key ON samples (service, ts, host);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+'''
+
+_INSERT = f'INSERT OR REPLACE INTO samples (host, ts, service, alive, {", ".join(METRICS)}) ' \
+          f'VALUES ({", ".join("?" * (4 + len(METRICS)))})'
+
+_Row = Tuple[Any, ...]
+
+
+class SQLiteStorage(DefaultTreeStorage, IHaveMetrics, IHaveRecords, IHaveRows, IBlockingStorage, IHaveVersion,
+                    IHaveSize):
+    """ Persistent samples in a WAL-mode SQLite database.
+
+    add_data only queues rows; a writer thread commits everything queued in one transaction every
+    FLUSH_INTERVAL seconds, so reads see new results after at most one interval. Reads run on
+    per-thread connections, callers on the event loop should use the executor """
+
+    def __init__(self, **kwargs):
+        self._path: str = kwargs.get('path', 'network_monitoring.sqlite3')
+        self._flush_interval: float = kwargs.get('flush_interval', 1.0)
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=kwargs.get('readers', 4), thread_name_prefix='sqlite')
+        self._lock = threading.Lock()
+        self._rows: List[_Row] = list()
+        self._deletes: List[Tuple[str, str]] = list()
+        # Bumped after each commit: queued rows are not visible to readers before it.
+        self._version = 0
+        self._stopped = threading.Event()
+        self._writer_lock = threading.Lock()
+        self._writer_connection = self._connect()
+        self._writer_connection.executescript(_SCHEMA)
+        self._services: List[str] = [service for service, in self._writer_connection.execute(
+            'SELECT DISTINCT service FROM samples')]
+        self._writer = threading.Thread(target=self._write_periodically, name='sqlite-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # WAL stays consistent on power loss with NORMAL, only the last commits may be lost.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @property
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    @property
+    def executor(self) -> Executor:
+        return self._executor
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def nbytes(self) -> int:
+        """ Database file plus its write-ahead log """
+        return sum(os.path.getsize(path) for path in (self._path, self._path + '-wal') if os.path.exists(path))
+
+    def add_key(self, name_key):
+        if name_key not in self._services:
+            self._services.append(name_key)
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        timestamps: Dict[str, int] = dict()
+        rows = list()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = timestamps.get(date)
+            if timestamp is None:
+                timestamp = timestamps[date] = parse_timestamp(date)
+            if isinstance(sample, ProbeSample):
+                rows.append((address, timestamp, service, sample.is_alive, *sample.metrics))
+            else:
+                rows.append((address, timestamp, service, bool(sample), *(None,) * len(METRICS)))
+            self.add_key(service)
+        with self._lock:
+            self._rows.extend(rows)
+
+    def remove_data(self, key):
+        column = 'service' if key in self._services else 'host'
+        with self._lock:
+            # Queued rows of the key would come back after the delete, so they are dropped here.
+            index = 0 if column == 'host' else 2
+            self._rows = [row for row in self._rows if row[index] != key]
+            self._deletes.append((column, key))
+        if column == 'service':
+            self._services.remove(key)
+
+    def flush(self):
+        """ Commit everything queued so far in a single transaction """
+        with self._lock:
+            rows, self._rows = self._rows, list()
+            deletes, self._deletes = self._deletes, list()
+        if not rows and not deletes:
+            return
+        with self._writer_lock, self._writer_connection as connection:
+            for column, key in deletes:
+                connection.execute(f'DELETE FROM samples WHERE {column} = ?', (key,))
+            connection.executemany(_INSERT, rows)
+        self._version += 1
+
+    def _write_periodically(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as exception:
+                logger.error(f'Ошибка записи в {self._path}: {exception}')
+        self.flush()
+        self._writer_connection.close()
+
+    def close(self):
+        """ Stop the writer after a final flush """
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._writer.join()
+            self._executor.shutdown(wait=False)
+
+    def _query(self, sql: str, parameters: Iterable = ()) -> List[_Row]:
+        return self._reader.execute(sql, tuple(parameters)).fetchall()
+
+    def _tree(self, rows: List[_Row], services: Iterable[str] = ()) -> dict:
+        tree = {service: dict() for service in services}
+        for service, timestamp, address, alive in rows:
+            tree.setdefault(service, dict()).setdefault(timestamp, dict())[address] = bool(alive)
+        return tree
+
+    def _lookup_tree(self) -> dict:
+        return self._tree(self._query('SELECT service, ts, host, alive FROM samples ORDER BY ts'), self._services)
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        if service not in self._services:
+            return None
+        rows = self._query('SELECT service, ts, host, alive FROM samples WHERE service = ? ORDER BY ts', (service,))
+        return self._tree(rows, (service,))[service]
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        rows = self._query('SELECT ts, alive FROM samples WHERE host = ? ORDER BY ts, service', (address,))
+        return {timestamp: bool(alive) for timestamp, alive in rows} if rows else None
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        rows = self._query('SELECT service, ts, host, alive FROM samples WHERE ts = ?', (timestamp,))
+        if not rows:
+            return None
+        tree = self._tree(rows)
+        service = next(service for service in self._services if service in tree)
+        return tree[service][timestamp]
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._services
+
+    def _has_host(self, address: str) -> bool:
+        return bool(self._query('SELECT 1 FROM samples WHERE host = ? LIMIT 1', (address,)))
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        rows = self._query('SELECT host, alive FROM samples WHERE service = ? AND ts = ?', (service, timestamp))
+        return {address: bool(alive) for address, alive in rows} if rows else None
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        rows = self._query('SELECT alive FROM samples WHERE host = ? AND ts = ? AND service = ?',
+                           (address, timestamp, service))
+        return bool(rows[0][0]) if rows else None
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        # The last service in name order wins, as it does in the {ts: state} history of _lookup_host.
+        rows = self._query('SELECT alive FROM samples WHERE host = ? AND ts = ? ORDER BY service', (address, timestamp))
+        return bool(rows[-1][0]) if rows else None
+
+    def rows(self, start: int = None, end: int = None, after: Tuple[str, int, str] = None,
+             services: List[str] = None, host: str = None) -> Iterator[Tuple[str, int, str, bool]]:
+        """ Walks samples_key from AFTER, so a page steps over its own rows only, or sorts just the rows of
+        HOST found by the primary key. The caller reads the whole page in one executor call, so the per-thread
+        connection serves it """
+        index = 'samples' if host is not None else 'samples INDEXED BY samples_key'
+        sql = [f'SELECT service, ts, host, alive FROM {index} WHERE ts >= ? AND ts <= ?']
+        parameters = [-2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end]
+        if after is not None:
+            sql.append('AND (service, ts, host) > (?, ?, ?)')
+            parameters.extend(after)
+        if services is not None:
+            sql.append(f'AND service IN ({", ".join("?" * len(services))})')
+            parameters.extend(services)
+        if host is not None:
+            sql.append('AND host = ?')
+            parameters.append(host)
+        cursor = self._reader.execute(' '.join(sql + ['ORDER BY service, ts, host']), parameters)
+        try:
+            for service, timestamp, address, alive in cursor:
+                yield service, timestamp, address, bool(alive)
+        finally:
+            cursor.close()
+
+    def records(self, start: int = None, end: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+        """ Rows straight from a cursor on a connection of its own, as the generator may be resumed
+        from any executor thread """
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT service, ts, host, alive FROM samples WHERE ts >= ? AND ts <= ? '
+                                      'ORDER BY service, ts', (-2 ** 63 if start is None else start,
+                                                               2 ** 63 - 1 if end is None else end))
+            for service, timestamp, address, alive in rows:
+                yield service, timestamp, address, bool(alive)
+        finally:
+            connection.close()
+
+    def get_metrics(self, address: str = None) -> dict:
+        columns = ', '.join(METRICS)
+        if address is None:
+            rows = self._query(f'SELECT host, ts, {columns} FROM samples WHERE avg_rtt IS NOT NULL ORDER BY host, ts')
+        else:
+            rows = self._query(f'SELECT host, ts, {columns} FROM samples WHERE host = ? AND avg_rtt IS NOT NULL '
+                               f'ORDER BY ts', (address,))
+        result = dict()
+        for address_, timestamp, *metrics in rows:
+            result.setdefault(address_, list()).append(dict(time=timestamp, **dict(zip(METRICS, metrics))))
+        return result
@@ -1,8 +1,16 @@
+import sys
 from abc import ABC, abstractmethod
-from typing import Any, Union, List
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import Executor
+from typing import Any, Union, List, Dict, Optional, Callable, Iterator, Tuple
 
 from observer import IObserver
 from result import IResult, IHaveJSONResult, HTMLResult, JSONResult
+from sample import ProbeSample, MetricsBuffer, parse_timestamp
+from telemetry import registry
+
+ADD_DATA_SECONDS = registry.histogram('nmf_storage_add_data_seconds', 'Time one add_data call takes')
+SAMPLES_WRITTEN = registry.counter('nmf_storage_samples_total', 'Samples handed to storage add_data')
 
 
 class IStorage(ABC):
@@ -23,6 +31,14 @@ class IStorage(ABC):
         pass
 
 
+def write(storage: 'IStorage', value: dict):
+    """ storage.add_data(value), timed and counted for /metrics """
+    with ADD_DATA_SECONDS.time():
+        storage.add_data(value)
+    SAMPLES_WRITTEN.inc(sum(len(hosts) for dates in value.values() if isinstance(dates, dict)
+                            for hosts in dates.values() if isinstance(hosts, dict)))
+
+
 class IHaveStorage(ABC):
     @abstractmethod
     def set_storage(self, storage: IStorage):
@@ -33,58 +49,543 @@ class IHaveStorage(ABC):
         pass
 
 
-class RAMMemoryStorage(IStorage, IHaveJSONResult):
+class IHaveMetrics(ABC):
+    @abstractmethod
+    def get_metrics(self, address: str = None) -> dict:
+        pass
+
+
+class IHaveAvailability(ABC):
+    @abstractmethod
+    def availability(self, start: float = None, end: float = None, address: str = None) -> Dict[str, dict]:
+        pass
+
+
+class IHaveRange(ABC):
+    @abstractmethod
+    def get_range(self, start: int = None, end: int = None, host: str = None, limit: int = None) -> dict:
+        """ {service: {timestamp: {address: is_alive}}} for START <= timestamp <= END, at most LIMIT
+        timestamps per service: the first ones after START, or the latest ones when START is None """
+        pass
+
+
+class IHaveRecords(ABC):
+    @abstractmethod
+    def records(self, start: int = None, end: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+        """ (service, timestamp, address, is_alive) with START <= timestamp <= END, produced as they are
+        read so that exports do not hold the whole range in memory """
+        pass
+
+
+class IHaveRows(ABC):
+    @abstractmethod
+    def rows(self, start: int = None, end: int = None, after: Tuple[str, int, str] = None,
+             services: List[str] = None, host: str = None) -> Iterator[Tuple[str, int, str, bool]]:
+        """ (service, timestamp, address, is_alive) with START <= timestamp <= END in (service, timestamp,
+        address) order, beginning after the key AFTER, so that a page reads its own rows, not the range """
+        pass
+
+
+class IHavePath(ABC):
+    @abstractmethod
+    def get_path(self, keys: list) -> Any:
+        """ get_data(KEYS[0]) indexed by each next key in turn, without building what the keys skip """
+        pass
+
+
+def walk(value, keys: list):
+    """ Index VALUE by each of KEYS in turn, digit strings also as ints; None once there is nothing to index """
+    for key in keys:
+        if not isinstance(value, (dict, ChunkedDates)):
+            return None
+        if key not in value and isinstance(key, str) and key.isdigit():
+            key = int(key)
+        value = value.get(key)
+    return value
+
+
+def limit_range(timestamps: list, start: int = None, end: int = None, limit: int = None) -> list:
+    """ Slice of sorted TIMESTAMPS selected by binary search, as IHaveRange.get_range describes """
+    first = 0 if start is None else bisect_left(timestamps, start)
+    last = len(timestamps) if end is None else bisect_right(timestamps, end)
+    if limit is not None:
+        if start is None:
+            first = max(first, last - limit)
+        else:
+            last = min(last, first + limit)
+    return timestamps[first:last]
+
+
+def normalize_key(key):
+    """ Path segments may arrive quoted, as in /api/nmf/'10.0.0.1' """
+    try:
+        return key.replace('\'', '')
+    except AttributeError:
+        return key
+
+
+def to_timestamp(key) -> Optional[int]:
+    try:
+        return parse_timestamp(key)
+    except (TypeError, ValueError):
+        return None
+
+
+class DefaultTreeStorage(IStorage, IHaveJSONResult, IHavePath):
+    """ get_data and its HTML and JSON views for backends that keep samples in a layout of their own.
+
+    get_data returns the same {service: {date: {address: is_alive}}} tree as RAMMemoryStorage, and KEY
+    narrows it to a service subtree, an address's {date: is_alive} history or a date's hosts. Backends
+    implement only the lookups, each returning None for a key it does not know.
+
+    get_path answers deeper paths with the narrower lookups below; their defaults go through the subtree,
+    backends with an index override them """
+
+    @abstractmethod
+    def _lookup_tree(self) -> dict:
+        pass
+
+    @abstractmethod
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        """ Hosts of the first service with a cycle at TIMESTAMP """
+        pass
+
+    def get_data(self, key=None) -> Union[dict, Any]:
+        key = normalize_key(key)
+        if key is None:
+            return self._lookup_tree()
+        result = self._lookup_service(key)
+        if result is None:
+            result = self._lookup_host(key)
+        if result is None:
+            timestamp = to_timestamp(key)
+            result = None if timestamp is None else self._lookup_date(timestamp)
+        return result
+
+    def _has_service(self, service: str) -> bool:
+        return self._lookup_service(service) is not None
+
+    def _has_host(self, address: str) -> bool:
+        return self._lookup_host(address) is not None
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        """ Hosts of SERVICE at TIMESTAMP """
+        return (self._lookup_service(service) or dict()).get(timestamp)
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        hosts = self._lookup_cycle(service, timestamp)
+        return None if hosts is None else hosts.get(address)
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        """ What get_data(ADDRESS) holds at TIMESTAMP """
+        return (self._lookup_host(address) or dict()).get(timestamp)
+
+    def get_path(self, keys: list) -> Any:
+        key, rest = normalize_key(keys[0]), keys[1:]
+        if not rest:
+            return self.get_data(key)
+        timestamp = to_timestamp(rest[0]) if isinstance(rest[0], int) or rest[0].isdigit() else None
+        if self._has_service(key):
+            if timestamp is None or len(rest) > 2:
+                return None
+            if len(rest) == 1:
+                return self._lookup_cycle(key, timestamp)
+            return self._lookup_sample(key, timestamp, rest[1])
+        if self._has_host(key):
+            return None if timestamp is None or len(rest) > 1 else self._lookup_host_at(key, timestamp)
+        timestamp = to_timestamp(key)
+        return walk(None if timestamp is None else self._lookup_date(timestamp), rest)
+
+    def get_data_html(self):
+        return HTMLResult(data=self.get_data()).get()
+
+    def get_data_json(self):
+        return JSONResult(data=self.get_data()).get()
+
+
+class IHaveTransitions(ABC):
+    @abstractmethod
+    def current(self, address: str = None, service: str = None):
+        pass
+
+    @abstractmethod
+    def down_since(self, address: str, service: str = None) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def transitions(self, address: str, service: str = None) -> List[dict]:
+        pass
+
+
+class ICompactableStorage(ABC):
+    @abstractmethod
+    def compact(self):
+        pass
+
+
+class IHaveAsyncCompaction(ABC):
+    @abstractmethod
+    async def compact_async(self):
+        """ compact() with its file I/O moved off the event loop """
+        pass
+
+
+class IHaveVersion(ABC):
+    """ VERSION changes whenever a write may have changed what the storage returns """
+    @property
+    @abstractmethod
+    def version(self) -> int:
+        pass
+
+
+class IHaveSize(ABC):
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        """ Memory or disk the stored samples take, cheap enough to read on every scrape """
+        pass
+
+
+class IBlockingStorage(ABC):
+    """ Storage whose calls block on I/O: code on the event loop runs them in this executor """
+    @property
+    @abstractmethod
+    def executor(self) -> Executor:
+        pass
+
+
+class Snapshot:
+    """ One published version of a storage tree; nothing reachable from it is mutated once published.
+
+    A storage that keeps the tree in another shape passes that as SOURCE and BUILD, and DATA is then
+    built from it on first use """
+    __slots__ = 'version', 'source', '_build', '_data', '_views'
+
+    def __init__(self, version: int, source: dict, build: Callable[[dict], dict] = None):
+        self.version = version
+        self.source = source
+        self._build = build
+        self._data: Optional[dict] = source if build is None else None
+        self._views: Dict[str, Any] = dict()
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = self._build(self.source)
+        return self._data
+
+    def view(self, name: str, build: Callable[[dict], Any]) -> Any:
+        """ BUILD(data), computed once per version and shared by every reader of it """
+        return self.memo(name, lambda: build(self.data))
+
+    def memo(self, name: str, build: Callable[[], Any]) -> Any:
+        """ BUILD(), computed once per version, for values read from SOURCE without building DATA """
+        try:
+            return self._views[name]
+        except KeyError:
+            value = self._views[name] = build()
+            return value
+
+
+# Seconds of timestamps per ChunkedDates bucket.
+CHUNK_SECONDS = 3600
+
+_MISSING = object()
+
+
+class ChunkedDates:
+    """ {timestamp: hosts} of one service in CHUNK_SECONDS buckets, none of them changed once published:
+    a new version copies the bucket map and the buckets its batch touches, not the whole history """
+    __slots__ = 'buckets',
+
+    def __init__(self, buckets: Dict[int, dict] = None):
+        self.buckets: Dict[int, dict] = dict() if buckets is None else buckets
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def __contains__(self, timestamp) -> bool:
+        return self.get(timestamp, _MISSING) is not _MISSING
+
+    def __getitem__(self, timestamp):
+        value = self.get(timestamp, _MISSING)
+        if value is _MISSING:
+            raise KeyError(timestamp)
+        return value
+
+    def get(self, timestamp, default=None):
+        if not isinstance(timestamp, int):
+            return default
+        bucket = self.buckets.get(timestamp - timestamp % CHUNK_SECONDS)
+        return default if bucket is None else bucket.get(timestamp, default)
+
+    def merged(self, dates: Dict[int, Any]) -> 'ChunkedDates':
+        """ A new version with DATES added """
+        buckets = dict(self.buckets)
+        copied = set()
+        for timestamp, hosts in dates.items():
+            start = timestamp - timestamp % CHUNK_SECONDS
+            if start not in copied:
+                buckets[start] = dict(buckets.get(start, ()))
+                copied.add(start)
+            buckets[start][timestamp] = hosts
+        return ChunkedDates(buckets)
+
+    def to_dict(self) -> dict:
+        return {timestamp: hosts for bucket in self.buckets.values() for timestamp, hosts in bucket.items()}
+
+
+def _tree(services: dict) -> dict:
+    """ The {service: {timestamp: hosts}} tree of RAMMemoryStorage's {service: ChunkedDates} """
+    return {service: dates.to_dict() if isinstance(dates, ChunkedDates) else dates
+            for service, dates in services.items()}
+
+
+class IHaveSnapshot(ABC):
+    @abstractmethod
+    def snapshot(self) -> Snapshot:
+        pass
+
+
+class RAMMemoryStorage(IStorage, IHaveJSONResult, IHaveMetrics, IHaveRange, IHaveRecords, IHaveRows, IHavePath,
+                       IHaveSnapshot, IHaveVersion, IHaveSize):
+    """ Every add_data batch publishes a new Snapshot: the ChunkedDates buckets and timestamp dicts it
+    changes are copied, the rest is shared with the previous version, so readers hold a version without
+    locks or copies and a write costs what its batch touches, however long the history is """
+
     def add_key(self, name_key):
-        if name_key not in self._storage.keys():
-            self._storage[name_key] = dict()
+        if name_key not in self._services:
+            self._publish({**self._services, name_key: ChunkedDates()})
 
     def __init__(self, **kwargs):
-        self._storage = dict()
+        self._snapshot = Snapshot(0, dict(), _tree)
+        self._metrics: Dict[str, MetricsBuffer] = dict()
+        # Bytes of the stored hosts dicts and metrics records, kept up to date by add_data.
+        self._tree_bytes = 0
+        self._metrics_bytes = 0
+        # Secondary indexes kept by add_data, so get_data(key) never walks the tree:
+        # timestamp -> services holding it, address -> {service: first timestamp holding it},
+        # service -> its timestamps in ascending order for range queries.
+        self._dates: Dict[int, List[str]] = dict()
+        self._addresses: Dict[str, Dict[str, int]] = dict()
+        self._timestamps: Dict[str, List[int]] = dict()
+
+    @property
+    def _services(self) -> dict:
+        """ {service: ChunkedDates} of the current version """
+        return self._snapshot.source
+
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
+
+    @property
+    def nbytes(self) -> int:
+        """ The hosts dicts of the stored cycles plus the metrics records; the address strings they share
+        with the probe results are not counted """
+        return self._tree_bytes + self._metrics_bytes
+
+    def _publish(self, services: dict):
+        self._snapshot = Snapshot(self._snapshot.version + 1, services, _tree)
+
+    def _index(self, value: dict):
+        for service, dates in value.items():
+            if not isinstance(dates, dict):
+                continue
+            timestamps = self._timestamps.setdefault(service, list())
+            for date, hosts in dates.items():
+                services = self._dates.setdefault(date, list())
+                if service not in services:
+                    services.append(service)
+                    if not timestamps or timestamps[-1] < date:
+                        timestamps.append(date)
+                    else:
+                        insort(timestamps, date)
+                if isinstance(hosts, dict):
+                    for address in hosts:
+                        self._addresses.setdefault(address, dict()).setdefault(service, date)
+
+    def _reindex(self):
+        self._dates, self._addresses, self._timestamps = dict(), dict(), dict()
+        self._index(self._snapshot.data)
+
+    def _first(self, services, data: dict) -> str:
+        """ The service that comes first in storage order, as the old depth-first scan found it """
+        if len(services) == 1:
+            return next(iter(services))
+        return next(service for service in data if service in services)
+
+    def _record_metrics(self, address: str, timestamp: int, sample: ProbeSample):
+        """ RTT metrics go to per-host float32 buffers; the tree keeps only is_alive """
+        metrics = self._metrics.get(address)
+        if metrics is None:
+            metrics = self._metrics[address] = MetricsBuffer()
+        metrics.append(timestamp, sample)
+        self._metrics_bytes += MetricsBuffer.RECORD_SIZE
+
+    def get_metrics(self, address: str = None) -> dict:
+        if address is not None:
+            metrics = self._metrics.get(address)
+            return {address: metrics.records()} if metrics is not None else dict()
+        return {address_: metrics.records() for address_, metrics in self._metrics.items()}
 
     def get_data_html(self):
-        return HTMLResult(data=self._storage).get()
+        return self._snapshot.view('html', lambda data: HTMLResult(data=data).get())
 
     def get_data_json(self):
-        return JSONResult(data=self._storage).get()
+        return self._snapshot.view('json', lambda data: JSONResult(data=data).get())
 
     def add_data(self, value: dict, key: str = None):
-        if key is None:
-            for key_, value_ in value.items():
-                if key_ not in self._storage.keys():
-                    self._storage[key_] = value_
-                else:
-                    for key__, value__ in value_.items():
-                        if key__ not in self._storage[key_].keys():
-                            self._storage[key_][key__] = value__
-                        else:
-                            self._storage[key_][key__].update(value__)
-        elif key not in self._storage.keys():
-            self._storage[key] = value
-        else:
-            self._storage[key].update(value)
+        """ Merge a {service: {timestamp: {address: sample}}} batch into a new version; legacy
+        'd.m.Y H.M' keys become epoch ints so every service's timestamps sort """
+        if key is not None:
+            value = {key: value}
+        services = dict(self._services)
+        added = dict()
+        for service, dates in value.items():
+            if not isinstance(dates, dict):
+                services[service] = dates
+                continue
+            service_dates = services.get(service)
+            if not isinstance(service_dates, ChunkedDates):
+                service_dates = ChunkedDates()
+            added_dates = added[service] = dict()
+            for date, hosts in dates.items():
+                timestamp = date if isinstance(date, int) else parse_timestamp(date)
+                if isinstance(hosts, dict):
+                    previous = added_dates.get(timestamp, service_dates.get(timestamp))
+                    merged = dict(previous) if isinstance(previous, dict) else dict()
+                    for address, sample in hosts.items():
+                        if isinstance(sample, ProbeSample):
+                            self._record_metrics(address, timestamp, sample)
+                            sample = sample.is_alive
+                        merged[address] = sample
+                    hosts = merged
+                    self._tree_bytes += sys.getsizeof(hosts) - (sys.getsizeof(previous)
+                                                                if isinstance(previous, dict) else 0)
+                added_dates[timestamp] = hosts
+            services[service] = service_dates.merged(added_dates)
+        self._publish(services)
+        self._index(added)
 
     def remove_data(self, key):
-        self._storage.__delitem__(key)
+        services = dict(self._services)
+        del services[key]
+        self._publish(services)
+        self._reindex()
+        self._tree_bytes = sum(sys.getsizeof(hosts) for dates in services.values() if isinstance(dates, ChunkedDates)
+                               for bucket in dates.buckets.values() for hosts in bucket.values()
+                               if isinstance(hosts, dict))
 
     def get_data(self, key=None) -> Union[dict, Any]:
-        try:
-            key = key.replace('\'', '')
-        except AttributeError:
-            pass
-        if key is not None:
-            def find_key(key_, collection: dict):
-                for k, v in collection.items():
-                    result = None
-                    if k == key_:
-                        return v
-                    elif isinstance(v, dict):
-                        result = find_key(key_, v)
-                    if result is not None:
-                        return result
-
-            return find_key(key, self._storage)
-        else:
-            return self._storage
+        snapshot = self._snapshot
+        data = snapshot.source
+        key = normalize_key(key)
+        if key is None:
+            return snapshot.data
+        if key in data:
+            dates = data[key]
+            if not isinstance(dates, ChunkedDates):
+                return dates
+            return snapshot.memo(f'dates:{key}', dates.to_dict)
+        if key in self._addresses:
+            return snapshot.memo(f'host:{key}', lambda: self._history(key, data))
+        if isinstance(key, str) and key.isdigit():
+            key = int(key)
+        # Indexes may already describe a newer version than DATA, hence the lookups with get().
+        if key in self._dates:
+            return data.get(self._first(self._dates[key], data), dict()).get(key)
+        return None
+
+    def _history(self, address: str, data: dict) -> dict:
+        """ {timestamp: is_alive} of ADDRESS over every service, oldest first, as DefaultTreeStorage
+        backends return it; the address index says where each service starts holding it """
+        records = list()
+        for service, first in self._addresses[address].items():
+            dates, timestamps = data.get(service), self._timestamps.get(service, ())
+            if not isinstance(dates, ChunkedDates):
+                continue
+            for index in range(bisect_left(timestamps, first), len(timestamps)):
+                hosts = dates.get(timestamps[index])
+                if isinstance(hosts, dict) and address in hosts:
+                    records.append((timestamps[index], hosts[address]))
+        records.sort(key=lambda record: record[0])
+        return dict(records)
+
+    def get_path(self, keys: list) -> Any:
+        data = self._services
+        key = normalize_key(keys[0])
+        if len(keys) > 1 and key in data:
+            # One bucket lookup per key instead of the service's whole {timestamp: hosts} view.
+            return walk(data[key], keys[1:])
+        return walk(self.get_data(key), keys[1:])
+
+    def get_range(self, start: int = None, end: int = None, host: str = None, limit: int = None) -> dict:
+        data = self._services
+        result = dict()
+        for service, timestamps in list(self._timestamps.items()):
+            if host is not None and service not in self._addresses.get(host, ()):
+                continue
+            dates = data.get(service, dict())
+            if host is None:
+                result[service] = {timestamp: dates[timestamp]
+                                   for timestamp in limit_range(timestamps, start, end, limit) if timestamp in dates}
+                continue
+            # Nothing before the first timestamp holding HOST can match.
+            first = self._addresses[host][service] if start is None else max(start, self._addresses[host][service])
+            window = [timestamp for timestamp in limit_range(timestamps, first, end)
+                      if host in dates.get(timestamp, ())]
+            result[service] = {timestamp: {host: dates[timestamp][host]}
+                               for timestamp in limit_range(window, None if start is None else first, None, limit)}
+        return result
+
+    def records(self, start: int = None, end: int = None) -> Iterator[Tuple[str, int, str, bool]]:
+        # Published dicts never change, so the snapshot can be walked while writes go on.
+        data = self._services
+        for service, timestamps in list(self._timestamps.items()):
+            dates = data.get(service, dict())
+            for timestamp in limit_range(timestamps, start, end):
+                hosts = dates.get(timestamp)
+                if isinstance(hosts, dict):
+                    for address, value in hosts.items():
+                        yield service, timestamp, address, bool(value)
+
+    def rows(self, start: int = None, end: int = None, after: Tuple[str, int, str] = None,
+             services: List[str] = None, host: str = None) -> Iterator[Tuple[str, int, str, bool]]:
+        data = self._services
+        after_service, after_timestamp, after_address = after or (None, None, None)
+        names = sorted(service for service in self._timestamps
+                       if (services is None or service in services) and (after is None or service >= after_service)
+                       and (host is None or service in self._addresses.get(host, ())))
+        for service in names:
+            dates, timestamps = data.get(service), self._timestamps[service]
+            if not isinstance(dates, ChunkedDates):
+                continue
+            first = 0 if start is None else bisect_left(timestamps, start)
+            if service == after_service:
+                first = max(first, bisect_left(timestamps, after_timestamp))
+            last = len(timestamps) if end is None else bisect_right(timestamps, end)
+            for index in range(first, last):
+                timestamp = timestamps[index]
+                hosts = dates.get(timestamp)
+                if not isinstance(hosts, dict):
+                    continue
+                addresses = sorted(hosts) if host is None else [host] if host in hosts else []
+                if service == after_service and timestamp == after_timestamp:
+                    addresses = addresses[bisect_right(addresses, after_address):]
+                for address in addresses:
+                    yield service, timestamp, address, bool(hosts[address])
 
 
 class IStorageFacade(ABC):
@@ -114,6 +615,10 @@ class StorageFacade(IStorageFacade):
     def storage(self) -> IStorage:
         return self._storage
 
+    @storage.setter
+    def storage(self, value: IStorage):
+        self._storage = value
+
     @property
     def observer(self) -> IObserver:
         return self._observer
@@ -121,13 +626,15 @@ class StorageFacade(IStorageFacade):
     def __init__(self, storage: IStorage, observer: IObserver = None, **kwargs):
         self._storage: IStorage = storage
         self._observer: IObserver = observer
-        if self._observer is not None:
+        if isinstance(self._observer, IHaveStorageFacade):
+            self._observer.set_storage_facade(self)
+        elif self._observer is not None:
             self._observer.update = self._update
         super().__init__()
 
     def _update(self, result: Union[IResult, List[IResult]]) -> None:
         if isinstance(result, list):
             for res in result:
-                self.storage.add_data(res.get())
+                write(self.storage, res.get())
         elif isinstance(result, IResult):
-            self.storage.add_data(result.get())
+            write(self.storage, result.get())
@@ -0,0 +1,265 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Union, Optional, Tuple, Iterator
+
+from sample import iter_samples, parse_timestamp, is_alive
+from storage.storage import DefaultTreeStorage, IHaveTransitions, IHaveVersion
+
+TRANSITION, KEYFRAME = 0, 1
+
+
+def trim(timestamps: array, oldest: float):
+    """ Drop the TIMESTAMPS before OLDEST, in bulk once they are half of the array, so the copy is paid
+    once per window and the array stays under twice the window """
+    stale = bisect_left(timestamps, oldest)
+    if stale and stale * 2 >= len(timestamps):
+        del timestamps[:stale]
+
+
+class Timeline:
+    """ State changes of one host plus a keyframe every KEYFRAME_INTERVAL seconds of unchanged state.
+
+    The times the host was probed are kept apart for the last PROBE_RETENTION seconds only: hosts are
+    probed in batches, at their own backed-off intervals, so the cycles of their service do not tell when
+    a host was probed, but only the recent {date: state} history needs that """
+    __slots__ = 'state', 'since', 'first', 'last', 'timestamps', 'states', 'kinds', 'probes'
+
+    def __init__(self, timestamp: int, state: bool):
+        self.state = state
+        self.since = self.first = self.last = timestamp
+        self.timestamps = array('l', (timestamp,))
+        self.states = bytearray((state,))
+        self.kinds = bytearray((KEYFRAME,))
+        self.probes = array('l', (timestamp,))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp: int, state: bool, keyframe_interval: float, probe_retention: float = None) -> bool:
+        """ Returns True when a transition or keyframe was written """
+        if timestamp < self.last:
+            self._probed(timestamp, probe_retention)
+            return self._insert(timestamp, state)
+        self.last = timestamp
+        self._probed(timestamp, probe_retention)
+        if state != self.state:
+            kind = TRANSITION
+            self.state, self.since = state, timestamp
+        elif timestamp - self.timestamps[-1] >= keyframe_interval:
+            kind = KEYFRAME
+        else:
+            return False
+        self._write(len(self.timestamps), timestamp, state, kind)
+        return True
+
+    def _probed(self, timestamp: int, retention: float = None):
+        probes = self.probes
+        if not probes or timestamp > probes[-1]:
+            probes.append(timestamp)
+        else:
+            index = bisect_left(probes, timestamp)
+            if probes[index] != timestamp:
+                probes.insert(index, timestamp)
+        if retention is not None:
+            trim(probes, self.last - retention)
+
+    def _write(self, index: int, timestamp: int, state: bool, kind: int):
+        self.timestamps.insert(index, timestamp)
+        self.states.insert(index, state)
+        self.kinds.insert(index, kind)
+
+    def _insert(self, timestamp: int, state: bool) -> bool:
+        """ A late result, written only when it disagrees with the state recorded for its time """
+        index = bisect_right(self.timestamps, timestamp)
+        if index == 0:
+            self.first = timestamp
+            self._write(0, timestamp, state, KEYFRAME)
+        else:
+            previous = self.states[index - 1]
+            if previous == state:
+                return False
+            self._write(index, timestamp, state, TRANSITION)
+            # The late result only covers its own cycle, the state recorded before it resumes after it.
+            if index + 1 == len(self.timestamps) or self.timestamps[index + 1] > timestamp + 1:
+                self._write(index + 1, timestamp + 1, previous, TRANSITION)
+        index = len(self.states) - 1
+        while index > 0 and self.states[index - 1] == self.state:
+            index -= 1
+        self.since = self.timestamps[index]
+        return True
+
+    def at(self, timestamp: int) -> Optional[bool]:
+        """ State the host was found in at TIMESTAMP, None when it was not probed then """
+        index = bisect_left(self.probes, timestamp)
+        if index == len(self.probes) or self.probes[index] != timestamp:
+            return None
+        return bool(self.states[bisect_right(self.timestamps, timestamp) - 1])
+
+    def history(self) -> Iterator[Tuple[int, bool]]:
+        """ (timestamp, state) of every probe, rebuilt from the probe times and the transitions """
+        index, count = 0, len(self.timestamps)
+        for timestamp in self.probes:
+            while index + 1 < count and self.timestamps[index + 1] <= timestamp:
+                index += 1
+            yield timestamp, bool(self.states[index])
+
+    def changes(self) -> Iterator[Tuple[int, bool]]:
+        previous = None
+        for timestamp, state in zip(self.timestamps, self.states):
+            if state != previous:
+                yield timestamp, bool(state)
+            previous = state
+
+
+class TransitionStorage(DefaultTreeStorage, IHaveTransitions, IHaveVersion):
+    """ Change-only recording: per host only state transitions and periodic keyframes are kept for good,
+    its probe times and the timestamps of its service's cycles for the last PROBE_RETENTION seconds.
+    Any {date: state} view is rebuilt on read and covers that window; transitions cover everything """
+
+    def __init__(self, **kwargs):
+        self._keyframe_interval: float = kwargs.get('keyframe_interval', 60 * 60)
+        self._probe_retention: Optional[float] = kwargs.get('probe_retention', 24 * 60 * 60)
+        self._timelines: Dict[str, Dict[str, Timeline]] = dict()
+        self._dates: Dict[str, array] = dict()
+        self._written = 0
+        self._received = 0
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def add_key(self, name_key):
+        self._timelines.setdefault(name_key, dict())
+        self._dates.setdefault(name_key, array('l'))
+
+    def _add_date(self, service: str, timestamp: int):
+        dates = self._dates[service]
+        if dates and dates[-1] >= timestamp:
+            index = bisect_left(dates, timestamp)
+            if index < len(dates) and dates[index] == timestamp:
+                return
+            dates.insert(index, timestamp)
+        else:
+            dates.append(timestamp)
+        if self._probe_retention is not None:
+            trim(dates, dates[-1] - self._probe_retention)
+
+    def add_data(self, value: dict, key: str = None):
+        if key is not None:
+            value = {key: value}
+        self._version += 1
+        timestamps: Dict[Tuple[str, str], int] = dict()
+        for service, date, address, sample in iter_samples(value):
+            timestamp = timestamps.get((service, date))
+            if timestamp is None:
+                timestamp = timestamps[service, date] = parse_timestamp(date)
+                self.add_key(service)
+                self._add_date(service, timestamp)
+            self._received += 1
+            timelines = self._timelines[service]
+            timeline = timelines.get(address)
+            if timeline is None:
+                timelines[address] = Timeline(timestamp, is_alive(sample))
+                self._written += 1
+            elif timeline.add(timestamp, is_alive(sample), self._keyframe_interval, self._probe_retention):
+                self._written += 1
+
+    def remove_data(self, key):
+        self._version += 1
+        if key in self._timelines:
+            del self._timelines[key]
+            del self._dates[key]
+            return
+        for timelines in self._timelines.values():
+            timelines.pop(key, None)
+
+    def _timeline(self, address: str, service: str = None) -> Optional[Timeline]:
+        for service_, timelines in self._timelines.items():
+            if (service is None or service_ == service) and address in timelines:
+                return timelines[address]
+        return None
+
+    def current(self, address: str = None, service: str = None) -> Union[Optional[bool], Dict[str, bool]]:
+        """ Latest state of ADDRESS, or of every host; a dict lookup, no history is touched """
+        if address is not None:
+            timeline = self._timeline(address, service)
+            return timeline.state if timeline is not None else None
+        result = dict()
+        for service_, timelines in self._timelines.items():
+            if service is None or service_ == service:
+                for address_, timeline in timelines.items():
+                    result.setdefault(address_, timeline.state)
+        return result
+
+    def down_since(self, address: str, service: str = None) -> Optional[int]:
+        """ When the current outage of ADDRESS began, None while it is up """
+        timeline = self._timeline(address, service)
+        if timeline is None or timeline.state:
+            return None
+        return timeline.since
+
+    def transitions(self, address: str, service: str = None) -> List[dict]:
+        """ Every change of state of ADDRESS, the first entry is the state it was first seen in """
+        timeline = self._timeline(address, service)
+        if timeline is None:
+            return list()
+        return [{'time': timestamp, 'is_alive': state} for timestamp, state in timeline.changes()]
+
+    def stats(self) -> dict:
+        timelines = [timeline for timelines in self._timelines.values() for timeline in timelines.values()]
+        return {'received': self._received, 'written': self._written,
+                'records': sum(len(timeline) for timeline in timelines),
+                'probes': sum(len(timeline.probes) for timeline in timelines)}
+
+    def _service_tree(self, service: str) -> dict:
+        tree = {timestamp: dict() for timestamp in self._dates[service]}
+        for address, timeline in self._timelines[service].items():
+            for date, state in timeline.history():
+                tree[date][address] = state
+        return {date: hosts for date, hosts in tree.items() if hosts}
+
+    def _lookup_tree(self) -> dict:
+        return {service: self._service_tree(service) for service in self._timelines}
+
+    def _lookup_service(self, service: str) -> Optional[dict]:
+        return self._service_tree(service) if service in self._timelines else None
+
+    def _lookup_host(self, address: str) -> Optional[dict]:
+        for timelines in self._timelines.values():
+            if address in timelines:
+                return dict(timelines[address].history())
+        return None
+
+    def _hosts_at(self, service: str, timestamp: int) -> Optional[dict]:
+        """ Hosts probed at TIMESTAMP, None when SERVICE has no cycle there """
+        dates = self._dates[service]
+        index = bisect_left(dates, timestamp)
+        if index == len(dates) or dates[index] != timestamp:
+            return None
+        hosts = {address: timeline.at(timestamp) for address, timeline in self._timelines[service].items()}
+        return {address: state for address, state in hosts.items() if state is not None}
+
+    def _lookup_date(self, timestamp: int) -> Optional[dict]:
+        for service in self._timelines:
+            hosts = self._hosts_at(service, timestamp)
+            if hosts is not None:
+                return hosts
+        return None
+
+    def _has_service(self, service: str) -> bool:
+        return service in self._timelines
+
+    def _has_host(self, address: str) -> bool:
+        return any(address in timelines for timelines in self._timelines.values())
+
+    def _lookup_cycle(self, service: str, timestamp: int) -> Optional[dict]:
+        return self._hosts_at(service, timestamp) or None
+
+    def _lookup_sample(self, service: str, timestamp: int, address: str) -> Optional[bool]:
+        timeline = self._timelines.get(service, dict()).get(address)
+        return None if timeline is None else timeline.at(timestamp)
+
+    def _lookup_host_at(self, address: str, timestamp: int) -> Optional[bool]:
+        timeline = self._timeline(address)
+        return None if timeline is None else timeline.at(timestamp)
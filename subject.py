@@ -4,7 +4,10 @@ from typing import List
 from loguru import logger
 
 from observer import IObserver
-from result import IResult, IHaveResult
+from result import IResult, IHaveResult, CycleResult
+from telemetry import registry
+
+NOTIFY_SECONDS = registry.histogram('nmf_notify_seconds', 'Time notify() takes to hand a result to every observer')
 
 
 class ISubject(ABC):
@@ -17,13 +20,16 @@ class ISubject(ABC):
         pass
 
     @abstractmethod
-    def notify(self) -> None:
+    def notify(self, result: IResult = None) -> None:
         pass
 
 
 class DefaultSubjectFacade(ISubject, IHaveResult):
     def set_result(self, value):
-        if isinstance(value, IResult):
+        if isinstance(value, CycleResult):
+            # A finished cycle replaces the previous one instead of being merged into it.
+            self._result = value
+        elif isinstance(value, IResult):
             self._result.set(value.get())
         else:
             self._result.set(value)
@@ -41,6 +47,9 @@ class DefaultSubjectFacade(ISubject, IHaveResult):
     def detach(self, observer: IObserver) -> None:
         self._observers.remove(observer)
 
-    def notify(self) -> None:
-        for observer in self._observers:
-            observer.update(self.get_result())
+    def notify(self, result: IResult = None) -> None:
+        if result is None:
+            result = self.get_result()
+        with NOTIFY_SECONDS.time():
+            for observer in self._observers:
+                observer.update(result)
@@ -0,0 +1,154 @@
+import ipaddress
+import socket
+from typing import Dict, Iterable, Iterator, Set, Union, List
+
+IPV6_FLAG = 1 << 128
+BLOCK_BITS = 16
+BLOCK_SIZE = 1 << BLOCK_BITS
+# Largest network or range one target spec may expand to: an IPv4 /8, an IPv6 /112.
+MAX_IPV4_ADDRESSES = 1 << 24
+MAX_IPV6_ADDRESSES = 1 << 16
+
+Address = Union[int, str]
+
+
+def to_int(address: str) -> Address:
+    """ Packed integer for an IP address, the string itself for a hostname """
+    try:
+        return int.from_bytes(socket.inet_aton(address), 'big') if address.count('.') == 3 else \
+            int(ipaddress.IPv6Address(address)) | IPV6_FLAG
+    except (OSError, ValueError):
+        return address
+
+
+def to_str(address: Address) -> str:
+    if isinstance(address, str):
+        return address
+    if address & IPV6_FLAG:
+        return str(ipaddress.IPv6Address(address ^ IPV6_FLAG))
+    return socket.inet_ntoa(address.to_bytes(4, 'big'))
+
+
+def _checked(spec: str, addresses: range) -> range:
+    """ ADDRESSES, or ValueError when the spec expands to more addresses than its family allows """
+    limit = MAX_IPV6_ADDRESSES if addresses.start & IPV6_FLAG else MAX_IPV4_ADDRESSES
+    if addresses.stop - addresses.start > limit:
+        raise ValueError(f'Слишком большой диапазон адресов: {spec}, допускается не больше {limit}')
+    return addresses
+
+
+def _network_range(network) -> range:
+    flag = IPV6_FLAG if network.version == 6 else 0
+    first, last = int(network.network_address), int(network.broadcast_address)
+    if network.num_addresses > 2:
+        first, last = first + 1, last - 1
+    return _checked(str(network), range(first | flag, (last | flag) + 1))
+
+
+def parse_target(spec: Address) -> Union[range, List[Address]]:
+    """ '10.0.0.0/24', '10.0.0.1-10.0.0.50', '10.0.0.1-50', a single address or a hostname """
+    if isinstance(spec, int):
+        return [spec]
+    spec = spec.strip()
+    if '/' in spec:
+        return _network_range(ipaddress.ip_network(spec, strict=False))
+    if '-' in spec:
+        start, _, end = spec.partition('-')
+        first = to_int(start)
+        if isinstance(first, int):
+            if end.isdigit() and '.' in start:
+                end = start.rsplit('.', 1)[0] + '.' + end
+            last = to_int(end)
+            if not isinstance(last, int) or last < first:
+                raise ValueError(f'Неверный диапазон адресов: {spec}')
+            return _checked(spec, range(first, last + 1))
+    return [to_int(spec)]
+
+
+def parse_targets(specs: Union[Address, Iterable[Address]]) -> Iterator[Address]:
+    if isinstance(specs, (str, int)):
+        specs = [specs]
+    for spec in specs:
+        yield from parse_target(spec)
+
+
+class AddressSet:
+    """ IPv4 addresses as bits in 64K-address blocks; IPv6 and hostnames in plain sets """
+
+    def __init__(self, targets: Union[str, Iterable[str]] = None, exclude: Union[str, Iterable[str]] = None):
+        self._blocks: Dict[int, bytearray] = dict()
+        self._other: Set[Address] = set()
+        self._count = 0
+        if targets is not None:
+            self.update(targets, exclude)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, address: Address):
+        if isinstance(address, str):
+            address = to_int(address)
+        if isinstance(address, int) and not address & IPV6_FLAG:
+            block = self._blocks.get(address >> BLOCK_BITS)
+            offset = address & (BLOCK_SIZE - 1)
+            return block is not None and bool(block[offset >> 3] & (1 << (offset & 7)))
+        return address in self._other
+
+    def __iter__(self) -> Iterator[Address]:
+        for prefix in sorted(self._blocks):
+            base = prefix << BLOCK_BITS
+            for index, byte in enumerate(self._blocks[prefix]):
+                if byte:
+                    for bit in range(8):
+                        if byte & (1 << bit):
+                            yield base | (index << 3) | bit
+        yield from self._other
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._blocks) * BLOCK_SIZE // 8
+
+    def add(self, address: Address) -> bool:
+        """ True if the address was not in the set yet """
+        if isinstance(address, str):
+            address = to_int(address)
+        if address in self:
+            return False
+        if isinstance(address, int) and not address & IPV6_FLAG:
+            block = self._blocks.get(address >> BLOCK_BITS)
+            if block is None:
+                block = self._blocks[address >> BLOCK_BITS] = bytearray(BLOCK_SIZE // 8)
+            offset = address & (BLOCK_SIZE - 1)
+            block[offset >> 3] |= 1 << (offset & 7)
+        else:
+            self._other.add(address)
+        self._count += 1
+        return True
+
+    def discard(self, address: Address) -> bool:
+        """ True if the address was in the set """
+        if isinstance(address, str):
+            address = to_int(address)
+        if address not in self:
+            return False
+        if isinstance(address, int) and not address & IPV6_FLAG:
+            block = self._blocks[address >> BLOCK_BITS]
+            offset = address & (BLOCK_SIZE - 1)
+            block[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+            if not any(block):
+                del self._blocks[address >> BLOCK_BITS]
+        else:
+            self._other.discard(address)
+        self._count -= 1
+        return True
+
+    def update(self, targets: Union[str, Iterable[str]], exclude: Union[str, Iterable[str]] = None) -> List[Address]:
+        """ Add target specs minus EXCLUDE; returns the addresses that were new """
+        excluded = AddressSet(exclude) if exclude else None
+        added = list()
+        for address in parse_targets(targets):
+            if excluded is not None and address in excluded:
+                continue
+            if self.add(address):
+                added.append(address)
+        return added
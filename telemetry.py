@@ -0,0 +1,203 @@
+import asyncio
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, List, Tuple, Callable, Iterable, Union, Optional
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+Labels = Tuple[str, ...]
+
+
+class Counter:
+    __slots__ = 'value',
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = 'value',
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    """ Counts per bucket are kept non-cumulative, observe() is one bisect and three additions """
+    __slots__ = 'bounds', 'counts', 'sum', 'count'
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+
+class Timer:
+    """ with histogram.time(): ... observes the seconds the block took """
+    __slots__ = 'histogram', 'started'
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.started)
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+def _escape(value: str) -> str:
+    if '\\' not in value and '"' not in value and '\n' not in value:
+        return value
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Labels, values: Labels, extra: str = '') -> str:
+    if len(names) == 1 and not extra:
+        return f'{{{names[0]}="{_escape(str(values[0]))}"}}'
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if isinstance(value, int):
+        return str(int(value))
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Family:
+    """ One metric name; every label combination gets its metric on first use and keeps it, so
+    callers that hold on to the child pay no lookup on the hot path """
+
+    def __init__(self, name: str, help_: str, kind: str, labels: Labels = (), buckets: Tuple[float, ...] = None):
+        self.name = name
+        self.help = help_
+        self.kind = kind
+        self.label_names = labels
+        self._buckets = buckets
+        self._children: Dict[Labels, Metric] = dict()
+
+    def labels(self, *values: str) -> Metric:
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name}: ожидаются метки {", ".join(self.label_names)}')
+            child = self._children[values] = Histogram(self._buckets) if self.kind == 'histogram' else \
+                Counter() if self.kind == 'counter' else Gauge()
+        return child
+
+    def render(self, lines: List[str]):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        for values, metric in self._children.items():
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip((*metric.bounds, float('inf')), metric.counts):
+                    cumulative += count
+                    le = _labels(self.label_names, values, f'le="{_number(bound)}"')
+                    lines.append(f'{self.name}_bucket{le} {cumulative}')
+                labels = _labels(self.label_names, values)
+                lines.append(f'{self.name}_sum{labels} {_number(metric.sum)}')
+                lines.append(f'{self.name}_count{labels} {metric.count}')
+            else:
+                lines.append(f'{self.name}{_labels(self.label_names, values)} {_number(metric.value)}')
+
+
+class CallbackFamily(Family):
+    """ Values read at scrape time from state the program keeps anyway, nothing is updated in between """
+
+    def __init__(self, name: str, help_: str, kind: str, labels: Labels,
+                 collect: Callable[[], Iterable[Tuple[Labels, float]]]):
+        super().__init__(name, help_, kind, labels)
+        self._collect = collect
+
+    def render(self, lines: List[str]):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        name, label_names = self.name, self.label_names
+        for values, value in self._collect():
+            lines.append(f'{name}{_labels(label_names, values)} {_number(value)}')
+
+
+class Registry:
+    def __init__(self):
+        self._families: Dict[str, Family] = dict()
+
+    def _add(self, family: Family) -> Family:
+        if family.name in self._families:
+            raise ValueError(f'Метрика {family.name} уже зарегистрирована')
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name: str, help_: str, labels: Labels = ()) -> Union[Family, Counter]:
+        """ The counter itself when it has no labels, else its Family """
+        family = self._add(Family(name, help_, 'counter', labels))
+        return family if labels else family.labels()
+
+    def gauge(self, name: str, help_: str, labels: Labels = ()) -> Union[Family, Gauge]:
+        family = self._add(Family(name, help_, 'gauge', labels))
+        return family if labels else family.labels()
+
+    def histogram(self, name: str, help_: str, labels: Labels = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Union[Family, Histogram]:
+        family = self._add(Family(name, help_, 'histogram', labels, buckets))
+        return family if labels else family.labels()
+
+    def callback(self, name: str, help_: str, collect: Callable[[], Iterable[Tuple[Labels, float]]],
+                 labels: Labels = (), kind: str = 'gauge') -> Family:
+        return self._add(CallbackFamily(name, help_, kind, labels, collect))
+
+    def unregister(self, name: str):
+        self._families.pop(name, None)
+
+    def render(self) -> str:
+        """ Prometheus text exposition format 0.0.4 """
+        lines = list()
+        for family in self._families.values():
+            family.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+LOOP_LAG = registry.gauge('nmf_event_loop_lag_last_seconds', 'How late the last loop lag probe woke up')
+LOOP_LAG_HISTOGRAM = registry.histogram('nmf_event_loop_lag_seconds', 'How late loop lag probes woke up')
+
+
+async def watch_loop_lag(interval: float = 0.5, stop: Optional[asyncio.Event] = None):
+    """ Sleeps INTERVAL in a loop and records how much longer than that each sleep took """
+    loop = asyncio.get_running_loop()
+    while stop is None or not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_HISTOGRAM.observe(lag)
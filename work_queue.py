@@ -0,0 +1,139 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from itertools import count
+from typing import Dict, Deque, Hashable, List, Iterator, Set
+
+from scheduler import IScheduler, ProbeScheduler
+
+
+class IWorkQueue(ABC):
+    @abstractmethod
+    def register(self) -> int:
+        pass
+
+    @abstractmethod
+    def unregister(self, worker: int):
+        pass
+
+    @abstractmethod
+    def add(self, host: Hashable, critical: bool = False):
+        pass
+
+    @abstractmethod
+    def remove(self, host: Hashable):
+        pass
+
+    @abstractmethod
+    async def get(self, worker: int) -> List[Hashable]:
+        pass
+
+    @abstractmethod
+    def report(self, host: Hashable, is_alive: bool):
+        pass
+
+    @abstractmethod
+    def is_critical(self, host: Hashable) -> bool:
+        pass
+
+
+class IHaveWorkQueue(ABC):
+    @abstractmethod
+    def set_work_queue(self, work_queue: IWorkQueue):
+        pass
+
+    @abstractmethod
+    def get_work_queue(self) -> IWorkQueue:
+        pass
+
+
+class WorkStealingQueue(IWorkQueue):
+    """ Due hosts are dealt to per-worker deques; an idle worker steals from the busiest one """
+
+    def __init__(self, **kwargs):
+        self._scheduler: IScheduler = kwargs.get('scheduler')
+        if self._scheduler is None:
+            self._scheduler = ProbeScheduler()
+        self._batch_size: int = kwargs.get('batch_size', 32)
+        self._deques: Dict[int, Deque[Hashable]] = dict()
+        # Hosts sitting in some deque: due() hands them out again if they wait past their lease.
+        self._dealt: Set[Hashable] = set()
+        self._workers = count()
+
+    def __len__(self):
+        return len(self._scheduler)
+
+    def __contains__(self, host: Hashable):
+        return host in self._scheduler
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._scheduler)
+
+    @property
+    def scheduler(self) -> IScheduler:
+        return self._scheduler
+
+    def register(self) -> int:
+        worker = next(self._workers)
+        self._deques[worker] = deque()
+        return worker
+
+    def unregister(self, worker: int):
+        own = self._deques.pop(worker, deque())
+        if own and self._deques:
+            self._deal(list(own), next(iter(self._deques)))
+
+    def add(self, host: Hashable, critical: bool = False):
+        self._scheduler.add(host, critical=critical)
+
+    def remove(self, host: Hashable):
+        # Hosts already dealt to a deque are skipped when they are taken.
+        self._scheduler.remove(host)
+
+    def report(self, host: Hashable, is_alive: bool):
+        self._scheduler.report(host, is_alive)
+
+    def is_critical(self, host: Hashable) -> bool:
+        return self._scheduler.is_critical(host)
+
+    def _deal(self, hosts: List[Hashable], first: int):
+        workers = list(self._deques)
+        start = workers.index(first)
+        workers = workers[start:] + workers[:start]
+        share = -(-len(hosts) // len(workers))
+        for index, worker in enumerate(workers):
+            self._deques[worker].extend(hosts[index * share:(index + 1) * share])
+        self._dealt.update(hosts)
+
+    def _take(self, source: Deque[Hashable], size: int, right: bool = False) -> List[Hashable]:
+        pop = source.pop if right else source.popleft
+        batch = list()
+        while source and len(batch) < size:
+            host = pop()
+            self._dealt.discard(host)
+            if host in self._scheduler:
+                self._scheduler.lease(host)
+                batch.append(host)
+        return batch
+
+    def _steal(self, worker: int) -> List[Hashable]:
+        victim = max((w for w in self._deques if w != worker), key=lambda w: len(self._deques[w]), default=None)
+        if victim is None or len(self._deques[victim]) == 0:
+            return list()
+        source = self._deques[victim]
+        return self._take(source, min(self._batch_size, -(-len(source) // 2)), right=True)
+
+    def _next_batch(self, worker: int) -> List[Hashable]:
+        own = self._deques[worker]
+        if not own:
+            due = [host for host in self._scheduler.due() if host not in self._dealt]
+            if due:
+                self._deal(due, worker)
+        return self._take(own, self._batch_size) or self._steal(worker)
+
+    async def get(self, worker: int) -> List[Hashable]:
+        """ Next batch for WORKER; empty if nothing became due while waiting """
+        batch = self._next_batch(worker)
+        if not batch:
+            await self._scheduler.wait()
+            batch = self._next_batch(worker)
+        return batch